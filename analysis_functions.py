@@ -3,8 +3,8 @@ from qgis.PyQt.QtGui import QColor
 from qgis.PyQt.QtWidgets import QProgressDialog
 
 from qgis.core import (
+    Qgis,
     QgsProject,
-    QgsVectorLayer,
     QgsFeature,
     QgsGeometry,
     QgsPointXY,
@@ -13,21 +13,58 @@ from qgis.core import (
     QgsFillSymbol,
     QgsDistanceArea,
     QgsUnitTypes,
-    QgsSpatialIndex,
     QgsCoordinateReferenceSystem,
     QgsMarkerSymbol,
     QgsRuleBasedRenderer,
     QgsSymbol,
 )
+from qgis.utils import iface
 
 from .resources import *
 
 from .gtfs_db import Database
-from .utils import change_style_layer, route_type_to_speed
+from .utils import change_style_layer, create_memory_layer
+from .csr_graph import (
+    CSRGraph,
+    multi_source_bounded_dijkstra,
+    edges_within_cutoff,
+    shortest_path_tree,
+    tree_path,
+)
+from .spatial_index import HaversineIndex
+from .timetable import (
+    load_timetable,
+    load_stops_index,
+    format_gtfs_time,
+    PROFILE_PERCENTILE,
+)
 
-from collections import defaultdict, deque
+from collections import defaultdict
+import numpy as np
 import networkx as nx
-import osmnx as ox
+
+# the walking paths to the stops within the range are searched up to this multiple of the range
+PATH_DETOUR_FACTOR = 3
+
+
+def nearest_graph_nodes(G: nx.MultiDiGraph, xs: list, ys: list) -> list:
+    """Nearest node of the graph to each lon/lat point, with the snapping index attached when the graph was loaded"""
+
+    snapping_index = G.graph.get("snapping_index")
+    if snapping_index is None:
+        if "node_x" in G.graph:
+            snapping_index = HaversineIndex(
+                range(len(G)), G.graph["node_x"], G.graph["node_y"]
+            )
+        else:
+            snapping_index = HaversineIndex(
+                list(G.nodes),
+                [x for _, x in G.nodes(data="x")],
+                [y for _, y in G.nodes(data="y")],
+            )
+        G.graph["snapping_index"] = snapping_index
+
+    return snapping_index.nearest_ids(xs, ys)
 
 
 def create_and_load_nearest_starting_point(
@@ -39,30 +76,24 @@ def create_and_load_nearest_starting_point(
     """Create a layer to store the nearest starting point and fill it with the nearest starting point"""
 
     # calculate the nearest node of the starting point
-    nearest_node = ox.nearest_nodes(
+    nearest_node = nearest_graph_nodes(
         G,
-        starting_point_geometry.asPoint().x(),
-        starting_point_geometry.asPoint().y(),
-    )
+        [starting_point_geometry.asPoint().x()],
+        [starting_point_geometry.asPoint().y()],
+    )[0]
 
-    nearest_node_x = G.nodes[nearest_node]["x"]
-    nearest_node_y = G.nodes[nearest_node]["y"]
+    nearest_node_x = float(G.graph["node_x"][nearest_node])
+    nearest_node_y = float(G.graph["node_y"][nearest_node])
 
     nearest_node_point = QgsPointXY(nearest_node_x, nearest_node_y)
 
-    nearest_starting_point_layer = QgsVectorLayer(
-        "Point?crs=" + crs.authid(), "starting_point_route", "memory"
-    )
-
-    nearest_starting_point_layer.dataProvider().addAttributes(fields)
-    nearest_starting_point_layer.startEditing()
-
     # create a new feature
-    new_feature = QgsFeature(nearest_starting_point_layer.fields())
+    new_feature = QgsFeature(fields)
     new_feature.setGeometry(QgsGeometry.fromPointXY(nearest_node_point))
-    nearest_starting_point_layer.addFeature(new_feature)
 
-    nearest_starting_point_layer.commitChanges()
+    nearest_starting_point_layer, _ = create_memory_layer(
+        "Point", crs, "starting_point_route", fields, [new_feature]
+    )
 
     change_style_layer(nearest_starting_point_layer, "square", "blue", "2", None)
 
@@ -74,10 +105,10 @@ def create_and_load_nearest_starting_point(
 
 def calculate_circular_buffers(
     nearest_stops: list,
-    stops_layer: QgsVectorLayer,
+    crs: QgsCoordinateReferenceSystem,
     range: int,
 ):
-    """Calculate the circular buffers"""
+    """Calculate the circular buffers, only needed to draw them"""
 
     project = QgsProject.instance()
 
@@ -92,7 +123,7 @@ def calculate_circular_buffers(
 
         # create distance area
         distance_area = QgsDistanceArea()
-        distance_area.setSourceCrs(stops_layer.crs(), project.transformContext())
+        distance_area.setSourceCrs(crs, project.transformContext())
         distance_area.setEllipsoid(project.ellipsoid())
 
         distance_degrees = distance_area.convertLengthMeasurement(
@@ -108,6 +139,7 @@ def calculate_circular_buffers(
 
 def create_and_load_layer_circular_buffer(
     crs: QgsCoordinateReferenceSystem,
+    circular_buffer_list: list,
     nearest_stops_information: list,
     number_analysis: int,
 ):
@@ -116,7 +148,6 @@ def create_and_load_layer_circular_buffer(
     # TODO: numero di tipologie di mezzi
 
     (
-        circular_buffer_list,
         stops_id_list,
         total_stops_list,
         selected_stops_list,
@@ -134,34 +165,30 @@ def create_and_load_layer_circular_buffer(
     fields.append(QgsField("# Discarded Stops", QVariant.Int))
     fields.append(QgsField("# Transports", QVariant.Int))
 
-    circular_buffer_layer = QgsVectorLayer(
-        "Polygon?crs=" + crs.authid(), f"circular_buffer_{number_analysis}", "memory"
-    )
-
-    circular_buffer_layer.dataProvider().addAttributes(fields)
-    circular_buffer_layer.startEditing()
-
-    for (
+    features = []
+    for buffer_id, (
         circular_buffer,
         stop_id,
         total_stops,
         selected_stops,
         discarded_stops,
         transport_number,
-    ) in zip(
-        circular_buffer_list,
-        stops_id_list,
-        total_stops_list,
-        selected_stops_list,
-        discarded_stops_list,
-        transport_number_list,
+    ) in enumerate(
+        zip(
+            circular_buffer_list,
+            stops_id_list,
+            total_stops_list,
+            selected_stops_list,
+            discarded_stops_list,
+            transport_number_list,
+        )
     ):
         # create a new feature
-        new_feature = QgsFeature(circular_buffer_layer.fields())
+        new_feature = QgsFeature(fields)
         new_feature.setGeometry(circular_buffer)
         new_feature.setAttributes(
             [
-                circular_buffer_list.index(circular_buffer),
+                buffer_id,
                 stop_id,
                 total_stops,
                 selected_stops,
@@ -169,35 +196,35 @@ def create_and_load_layer_circular_buffer(
                 transport_number,
             ]
         )
-        circular_buffer_layer.addFeature(new_feature)
-
-        fill_symbol = QgsFillSymbol.createSimple(
-            {
-                "color": "cyan",
-                "outline_color": "black",
-                "outline_width": "0.5",
-                "style": "solid",
-            }
-        )
-        fill_symbol.setColor(QColor(0, 255, 255, 80))
-        circular_buffer_layer.renderer().setSymbol(fill_symbol)
+        features.append(new_feature)
 
-        # circular_buffer_list.append(circular_buffer)
+    circular_buffer_layer, _ = create_memory_layer(
+        "Polygon", crs, f"circular_buffer_{number_analysis}", fields, features
+    )
 
-    circular_buffer_layer.commitChanges()
+    fill_symbol = QgsFillSymbol.createSimple(
+        {
+            "color": "cyan",
+            "outline_color": "black",
+            "outline_width": "0.5",
+            "style": "solid",
+        }
+    )
+    fill_symbol.setColor(QColor(0, 255, 255, 80))
+    circular_buffer_layer.renderer().setSymbol(fill_symbol)
 
     project.addMapLayer(circular_buffer_layer)
 
 
 def create_and_load_layer_selected_stops(
     crs: QgsCoordinateReferenceSystem,
-    stops_layer: QgsVectorLayer,
-    circular_buffer_list: list,
+    range: int,
     transport_list: list,
     stops: list,
     number_analysis: int,
 ):
-    """Create a layer to store the selected stops and fill it with the selected stops"""
+    """Create a layer to store the selected stops and fill it with the selected stops.
+    The stops within `range` meters of every starting stop are found with a single radius query"""
 
     selected_stops_dict = defaultdict(list)
     selected = False
@@ -212,15 +239,9 @@ def create_and_load_layer_selected_stops(
     fields.append(QgsField("Transports", QVariant.String))
     fields.append(QgsField("SymbolType", QVariant.String))  # Aggiungi un campo per memorizzare il tipo di simbolo
 
-    selected_stops_layer = QgsVectorLayer(
-        "Point?crs=" + crs.authid(), f"selected_stops_{number_analysis}", "memory"
-    )
-
-    selected_stops_layer.dataProvider().addAttributes(fields)
-    selected_stops_layer.startEditing()
+    features = []
 
-    # create a spatial index for the stops layer (the bigger one)
-    stops_index = QgsSpatialIndex(stops_layer.getFeatures())
+    stops_index, stop_names = load_stops_index()
 
     (
         total_stops_list,
@@ -230,73 +251,85 @@ def create_and_load_layer_selected_stops(
         transport_number_list,
     ) = ([], [], [], [], [])
 
-    for circular_buffer, starting_transport_list, stop in zip(
-        circular_buffer_list, transport_list, stops
+    # stops within the range of every starting stop, nearest first
+    nearby_positions, nearby_distances = stops_index.query_radius(
+        [stop[2][0] for stop in stops],
+        [stop[2][1] for stop in stops],
+        range,
+        return_distance=True,
+    )
+    nearby_positions = [
+        positions[np.argsort(distances, kind="stable")].tolist()
+        for positions, distances in zip(nearby_positions, nearby_distances)
+    ]
+
+    stops_transports = Database().select_transports_by_stop_ids(
+        stops_index.ids[position] for positions in nearby_positions for position in positions
+    )
+
+    for starting_transport_list, stop, positions in zip(
+        transport_list, stops, nearby_positions
     ):
-        intersecting_stop_ids = stops_index.intersects(circular_buffer.boundingBox())
         starting_stop_id = stop[0]
+        stops_id_list.append(starting_stop_id)
 
         selected_stops, discarded_stops = 0, 0
-        previous_transport_set = set()
+        transport_set = set()
 
-        for stop_id in intersecting_stop_ids:
-            feature = stops_layer.getFeature(stop_id)
-            stop_point = feature.geometry()
+        for position in positions:
+            stop_id = stops_index.ids[position]
+            stop_name = stop_names[position]
 
-            selected_stop_transports = Database().select_transports_by_stop_id(
-                feature["ID"]
-            )
-            stops_id_list.append(feature["ID"])
-            selected_stop_transports_list = [
-                transport[0] for transport in selected_stop_transports
-            ]
+            selected_stop_transports_list = sorted(stops_transports[stop_id])
             selected_stop_transports_string = ", ".join(selected_stop_transports_list)
 
             # starting from transport list obtain the number of unique transports
-            transport_set = set(selected_stop_transports_list).union(
-                previous_transport_set
+            transport_set.update(selected_stop_transports_list)
+
+            if stop_id == starting_stop_id:
+                continue
+
+            stop_point = QgsGeometry.fromPointXY(
+                QgsPointXY(stops_index.x[position], stops_index.y[position])
             )
-            previous_transport_set = transport_set
-
-            if circular_buffer.contains(stop_point):
-                if feature["ID"] != starting_stop_id:
-                    new_feature = QgsFeature(selected_stops_layer.fields())
-                    new_feature.setGeometry(stop_point)
-                    if set(starting_transport_list).intersection(
-                        set(selected_stop_transports_list)
-                    ):
-                        new_feature.setAttributes(
-                            [
-                                starting_stop_id,
-                                feature["ID"],
-                                feature["Stop_name"],
-                                0,
-                                selected_stop_transports_string,
-                                'NonSelected'  # Imposta il tipo di simbolo come 'NonSelected'
-                            ]
-                        )
-                        discarded_stops += 1
-
-                    else:
-                        new_feature.setAttributes(
-                            [
-                                starting_stop_id,
-                                feature["ID"],
-                                feature["Stop_name"],
-                                1,
-                                selected_stop_transports_string,
-                                'Selected'  # Imposta il tipo di simbolo come 'Selected'
-                            ]
-                        )
-                        selected_stops += 1
-
-                        selected = True
-
-                        selected_stops_dict[starting_stop_id].append(
-                            [feature["ID"], feature["Stop_name"], stop_point]
-                        )
-
-                    selected_stops_layer.addFeature(new_feature)
+
+            new_feature = QgsFeature(fields)
+            new_feature.setGeometry(stop_point)
+            if set(starting_transport_list).intersection(
+                set(selected_stop_transports_list)
+            ):
+                new_feature.setAttributes(
+                    [
+                        starting_stop_id,
+                        stop_id,
+                        stop_name,
+                        0,
+                        selected_stop_transports_string,
+                        'NonSelected'  # Imposta il tipo di simbolo come 'NonSelected'
+                    ]
+                )
+                discarded_stops += 1
+
+            else:
+                new_feature.setAttributes(
+                    [
+                        starting_stop_id,
+                        stop_id,
+                        stop_name,
+                        1,
+                        selected_stop_transports_string,
+                        'Selected'  # Imposta il tipo di simbolo come 'Selected'
+                    ]
+                )
+                selected_stops += 1
+
+                selected = True
+
+                selected_stops_dict[starting_stop_id].append(
+                    [stop_id, stop_name, stop_point]
+                )
+
+            features.append(new_feature)
 
         total_stops = selected_stops + discarded_stops
         total_stops_list.append(total_stops)
@@ -304,7 +337,9 @@ def create_and_load_layer_selected_stops(
         discarded_stops_list.append(discarded_stops)
         transport_number_list.append(len(transport_set))
 
-    selected_stops_layer.commitChanges()
+    selected_stops_layer, _ = create_memory_layer(
+        "Point", crs, f"selected_stops_{number_analysis}", fields, features
+    )
 
     # Aggiungi i simboli basati sul tipo di simbolo
     symbols = {
@@ -325,7 +360,6 @@ def create_and_load_layer_selected_stops(
     project.addMapLayer(selected_stops_layer)
 
     nearest_stops_information = [
-        circular_buffer_list,
         stops_id_list,
         total_stops_list,
         selected_stops_list,
@@ -342,16 +376,16 @@ def create_and_load_layer_shortest_paths(
     selected_stops_dict: dict,
     G_walk: nx.Graph,
     number_analysis: int,
+    range: int = None,
 ):
-    """Create a layer to store the shortest paths and fill it with the shortest paths"""
+    """Create a layer to store the shortest paths and fill it with the shortest paths.
+    The stops are selected within `range` meters, so the searches stop at PATH_DETOUR_FACTOR times the range
+    and the user is warned about the selected stops farther than that on foot.
+    Return the (u, v, key) pedestrian edges of each path"""
 
     if not selected_stops_dict:
         print("No admitted stops found")
-        return
-
-    shortest_paths_layer = QgsVectorLayer(
-        "LineString?crs=" + crs.authid(), f"shortest_paths_{number_analysis}", "memory"
-    )
+        return []
 
     fields = QgsFields()
     fields.append(QgsField("From", QVariant.String))
@@ -360,49 +394,71 @@ def create_and_load_layer_shortest_paths(
     fields.append(QgsField("To_Stop_Name", QVariant.String))
     fields.append(QgsField("Length", QVariant.Double))
 
-    shortest_paths_layer.dataProvider().addAttributes(fields)
-    shortest_paths_layer.startEditing()
+    features = []
+    paths_edges = []
+    stops_without_path = []
 
-    for stop in nearest_stops:
+    # snap all the starting stops and all the selected stops in two batched queries
+    starting_nodes = nearest_graph_nodes(
+        G_walk, [stop[2][0] for stop in nearest_stops], [stop[2][1] for stop in nearest_stops]
+    )
+    selected_points = [
+        selected_stop[2].asPoint()
+        for stop in nearest_stops
+        for selected_stop in selected_stops_dict.get(stop[0], [])
+    ]
+    selected_nodes = iter(
+        nearest_graph_nodes(
+            G_walk,
+            [point.x() for point in selected_points],
+            [point.y() for point in selected_points],
+        )
+    )
+
+    walk_graph = CSRGraph.cached(G_walk, "length")
+    cutoff = range * PATH_DETOUR_FACTOR if range is not None else float("inf")
+
+    for stop, starting_point_nearest_node in zip(nearest_stops, starting_nodes):
         current_stop_id = stop[0]
         current_stop_name = stop[1]
-        x_coord = stop[2][0]
-        y_coord = stop[2][1]
-
-        starting_point_nearest_node = ox.nearest_nodes(G_walk, x_coord, y_coord)
 
         if current_stop_id in selected_stops_dict:
-            for selected_stop in selected_stops_dict[current_stop_id]:
+            selected_stops = selected_stops_dict[current_stop_id]
+            target_nodes = [
+                walk_graph.node_index[next(selected_nodes)] for _ in selected_stops
+            ]
+
+            # a single search from the starting stop reaches all its selected stops
+            distances, predecessors = shortest_path_tree(
+                walk_graph.arrays,
+                walk_graph.node_index[starting_point_nearest_node],
+                cutoff=cutoff,
+                targets=set(target_nodes),
+            )
+
+            for selected_stop, stop_nearest_node in zip(selected_stops, target_nodes):
                 selected_stop_id = selected_stop[0]
                 selected_stop_name = selected_stop[1]
-                selected_stop_point = selected_stop[2].asPoint()
-
-                stop_nearest_node = ox.nearest_nodes(
-                    G_walk, selected_stop_point.x(), selected_stop_point.y()
-                )
 
-                shortest_path = nx.shortest_path(
-                    G_walk,
-                    starting_point_nearest_node,
-                    stop_nearest_node,
-                    weight="length",
-                )
+                if stop_nearest_node not in distances:
+                    print(f"No path from stop {current_stop_id} to stop {selected_stop_id}")
+                    stops_without_path.append(f"{current_stop_name} - {selected_stop_name}")
+                    continue
 
-                shortest_paths_length = nx.shortest_path_length(
-                    G_walk,
-                    starting_point_nearest_node,
-                    stop_nearest_node,
-                    weight="length",
-                )
+                shortest_path, path_edges = tree_path(predecessors, stop_nearest_node)
+                shortest_paths_length = distances[stop_nearest_node]
 
                 path_line = [
-                    QgsPointXY(G_walk.nodes[node]["x"], G_walk.nodes[node]["y"])
+                    QgsPointXY(
+                        G_walk.nodes[walk_graph.nodes[node]]["x"],
+                        G_walk.nodes[walk_graph.nodes[node]]["y"],
+                    )
                     for node in shortest_path
                 ]
 
                 path_geometry = QgsGeometry.fromPolylineXY(path_line)
                 # create a new feature
-                new_feature = QgsFeature(shortest_paths_layer.fields())
+                new_feature = QgsFeature(fields)
                 new_feature.setGeometry(path_geometry)
                 new_feature.setAttributes(
                     [
@@ -414,9 +470,18 @@ def create_and_load_layer_shortest_paths(
                     ]
                 )
 
-                shortest_paths_layer.addFeature(new_feature)
+                features.append(new_feature)
 
-    shortest_paths_layer.commitChanges()
+                paths_edges.append(
+                    [
+                        (walk_graph.nodes[u], walk_graph.nodes[v], int(walk_graph.keys[edge]))
+                        for u, v, edge in zip(shortest_path, shortest_path[1:], path_edges)
+                    ]
+                )
+
+    shortest_paths_layer, _ = create_memory_layer(
+        "LineString", crs, f"shortest_paths_{number_analysis}", fields, features
+    )
 
     change_style_layer(shortest_paths_layer, None, "orange", None, "0.5")
 
@@ -424,6 +489,68 @@ def create_and_load_layer_shortest_paths(
     project.addMapLayer(shortest_paths_layer)
     print("Shortest paths layer loaded")
 
+    if stops_without_path:
+        iface.messageBar().pushMessage(
+            "Warning",
+            "No walking path"
+            + (f" within {cutoff:.0f} m" if range is not None else "")
+            + f" for {len(stops_without_path)} selected stops: "
+            + ", ".join(stops_without_path),
+            level=Qgis.Warning,
+            duration=5,
+        )
+
+    return paths_edges
+
+
+def service_area_travel_times(G: nx.DiGraph, starting_points: list, time_limit: float):
+    """Travel times in minutes from every starting point to the nodes reachable within `time_limit`,
+    as a sparse starting points x nodes matrix over the nodes of `G.graph["travel_times"]`"""
+
+    travel_times_graph = G.graph["travel_times"]
+    sources = [travel_times_graph.node_index[point] for point in starting_points]
+
+    return multi_source_bounded_dijkstra(
+        travel_times_graph.arrays, sources, time_limit
+    )
+
+
+def reachable_edges_from_travel_times(G: nx.DiGraph, travel_times, time_limit: float):
+    """Edges reachable from each starting point given its row of the travel times matrix"""
+
+    travel_times_graph = G.graph["travel_times"]
+    nodes = travel_times_graph.nodes
+
+    reachable_edges_list = []
+    for i in range(travel_times.shape[0]):
+        start, end = travel_times.indptr[i], travel_times.indptr[i + 1]
+        edges, edge_sources = edges_within_cutoff(
+            travel_times_graph.arrays,
+            travel_times.indices[start:end],
+            travel_times.data[start:end],
+            time_limit,
+        )
+
+        reachable_edges = []
+        for u, v, key in zip(
+            edge_sources.tolist(),
+            travel_times_graph.indices[edges].tolist(),
+            travel_times_graph.keys[edges].tolist(),
+        ):
+            edge_data = G.edges[nodes[u], nodes[v], key]
+            reachable_edges.append(
+                (
+                    nodes[u],
+                    nodes[v],
+                    edge_data["weight"],  # meters
+                    edge_data["transport"],
+                    edge_data["travel_time"],  # minutes
+                )
+            )
+        reachable_edges_list.append(reachable_edges)
+
+    return reachable_edges_list
+
 
 def create_and_load_layer_reachable_nodes(
     G: nx.DiGraph,
@@ -436,35 +563,11 @@ def create_and_load_layer_reachable_nodes(
 ):
     """Calculate reachable edges in a time limit"""
 
-    reachable_edges_list = []
-    # define a queue to store the nodes to visit
-    for starting_point in starting_points:
-        queue = deque([(starting_point, 0)])
-        reachable_edges = []
-        visited_edges = set()
-
-        while queue:
-            current_node, time_elapsed = queue.popleft()
-            # TODO: (1,2) added to visited_edges, but (2,1) is not added. Possible optimization
-            # TODO: Not discard the edge if used one time. Can exludes some important paths
-
-            for _, end_node, edge_data in G.out_edges(current_node, data=True):
-                if (current_node, end_node) not in visited_edges:
-                    distance = edge_data["weight"]  # meters
-                    route_type = edge_data["route_type"]  # km/h
-                    transport = edge_data["transport"]
-
-                    speed = route_type_to_speed(route_type)
-                    travel_time = (distance / 1000) / speed * 60  # minutes
-
-                    if time_elapsed + travel_time <= time_limit:
-                        reachable_edges.append(
-                            (current_node, end_node, distance, transport, travel_time)
-                        )
-                        visited_edges.add((current_node, end_node))
-                        queue.append((end_node, time_elapsed + travel_time))
-
-        reachable_edges_list.append(reachable_edges)
+    # all the starting points are searched in a single batch
+    travel_times = service_area_travel_times(G, starting_points, time_limit)
+    reachable_edges_list = reachable_edges_from_travel_times(
+        G, travel_times, time_limit
+    )
 
     selected_id = load_layer_reachable_edges(
         G, crs, reachable_edges_list, G_walk, checkbox, number_analysis
@@ -487,10 +590,6 @@ def load_layer_reachable_edges(
         print("No reachable edges found")
         return
 
-    service_area_layer = QgsVectorLayer(
-        "LineString?crs=" + crs.authid(), f"service_area_{number_analysis}", "memory"
-    )
-
     fields = QgsFields()
     fields.append(QgsField("ID", QVariant.String))
     fields.append(QgsField("From", QVariant.String))
@@ -499,22 +598,42 @@ def load_layer_reachable_edges(
     fields.append(QgsField("Transport", QVariant.String))
     fields.append(QgsField("Travel_time", QVariant.Double))
 
-    service_area_layer.dataProvider().addAttributes(fields)
-    service_area_layer.startEditing()
+    features = []
+    # starting point of each feature, to group their ids once the layer has assigned them
+    feature_origins = []
 
-    service_area_id = 1
-    selected_id = defaultdict(list)
+    nodes_x = G.graph["node_x"].tolist()
+    nodes_y = G.graph["node_y"].tolist()
+
+    # pedestrian node of every end of the walking edges, snapped in a single batched query
+    walk_nodes = {}
+    if checkbox:
+        walk_ends = list(
+            {
+                node
+                for reachable_edges in reachable_edges_list
+                for edge in reachable_edges
+                if edge[3] == "walk"
+                for node in edge[:2]
+            }
+        )
+        walk_nodes = dict(
+            zip(
+                walk_ends,
+                nearest_graph_nodes(
+                    G_walk,
+                    [nodes_x[node] for node in walk_ends],
+                    [nodes_y[node] for node in walk_ends],
+                ),
+            )
+        )
 
     for i, reachable_edges in enumerate(reachable_edges_list):
         for edge in reachable_edges:
             # if the transport is walk, calculate the shortest path between the two nodes via pedestrian graph and add the edges to the service area
             if edge[3] == "walk" and checkbox:
-                starting_point_nearest_node = ox.nearest_nodes(
-                    G_walk, G.nodes[edge[0]]["x"], G.nodes[edge[0]]["y"]
-                )
-                ending_point_nearest_node = ox.nearest_nodes(
-                    G_walk, G.nodes[edge[1]]["x"], G.nodes[edge[1]]["y"]
-                )
+                starting_point_nearest_node = walk_nodes[edge[0]]
+                ending_point_nearest_node = walk_nodes[edge[1]]
 
                 shortest_path = nx.shortest_path(
                     G_walk,
@@ -531,8 +650,8 @@ def load_layer_reachable_edges(
 
             else:
                 edge_coordinates = [
-                    (G.nodes[edge[0]]["x"], G.nodes[edge[0]]["y"]),
-                    (G.nodes[edge[1]]["x"], G.nodes[edge[1]]["y"]),
+                    (nodes_x[edge[0]], nodes_y[edge[0]]),
+                    (nodes_x[edge[1]], nodes_y[edge[1]]),
                 ]
 
                 p1 = QgsPointXY(edge_coordinates[0][0], edge_coordinates[0][1])
@@ -541,18 +660,22 @@ def load_layer_reachable_edges(
                 edge_geometry = QgsGeometry.fromPolylineXY([p1, p2])
 
             # create a new feature
-            new_feature = QgsFeature(service_area_layer.fields())
+            new_feature = QgsFeature(fields)
             new_feature.setGeometry(edge_geometry)
             new_feature.setAttributes(
-                [service_area_id, edge[0], edge[1], edge[2], edge[3], edge[4]]
+                [len(features) + 1, str(edge[0]), str(edge[1]), edge[2], edge[3], edge[4]]
             )
-            service_area_layer.addFeature(new_feature)
+            features.append(new_feature)
+            feature_origins.append(i)
 
-            # build a dictionary with the selected edges and the key must be referenced to the starting point
-            selected_id[i].append(service_area_id)
-            service_area_id += 1
+    service_area_layer, added_features = create_memory_layer(
+        "LineString", crs, f"service_area_{number_analysis}", fields, features
+    )
 
-    service_area_layer.commitChanges()
+    # build a dictionary with the selected edges and the key must be referenced to the starting point
+    selected_id = defaultdict(list)
+    for i, feature in zip(feature_origins, added_features):
+        selected_id[i].append(feature.id())
 
     change_style_layer(service_area_layer, None, "lavander", None, "0.5")
 
@@ -562,6 +685,107 @@ def load_layer_reachable_edges(
     return selected_id
 
 
+def create_and_load_layer_reachable_stops(
+    crs: QgsCoordinateReferenceSystem,
+    points: list,
+    time_limit: int,
+    departure_time: int,
+    number_analysis: int,
+    last_departure_time: int = None,
+    service_date: str = None,
+):
+    """Create a layer with the stops reachable from each point within the time limit, following the timetable
+    of the trips running on `service_date` (YYYYMMDD).
+    With `last_departure_time` every departure of the window is analysed and the layer stores the travel time statistics"""
+
+    timetable = load_timetable(service_date=service_date)
+
+    origins = [timetable.access_stops(point[0], point[1]) for point in points]
+
+    if last_departure_time is not None:
+        profiles = timetable.travel_time_profiles(
+            origins, departure_time, last_departure_time, time_limit * 60
+        )
+    else:
+        travel_times = timetable.earliest_arrivals(
+            origins, departure_time, time_limit * 60
+        )
+        profiles = [
+            {
+                "stops": travel_times.indices[start:end],
+                "first_time": travel_times.data[start:end],
+            }
+            for start, end in zip(travel_times.indptr[:-1], travel_times.indptr[1:])
+        ]
+
+    fields = QgsFields()
+    fields.append(QgsField("ID", QVariant.Int))
+    fields.append(QgsField("Origin", QVariant.Int))
+    fields.append(QgsField("Stop_id", QVariant.String))
+    fields.append(QgsField("Stop_name", QVariant.String))
+    fields.append(QgsField("Travel_time", QVariant.Double))
+    fields.append(QgsField("Arrival", QVariant.String))
+    if last_departure_time is not None:
+        fields.append(QgsField("Min_time", QVariant.Double))
+        fields.append(QgsField("Median_time", QVariant.Double))
+        fields.append(QgsField(f"P{PROFILE_PERCENTILE}_time", QVariant.Double))
+        fields.append(QgsField("Reachable_share", QVariant.Double))
+
+    features = []
+    feature_origins = []
+
+    stops_x = timetable.stops_index.x
+    stops_y = timetable.stops_index.y
+
+    # infinite travel times (stop not reachable at that departure) are stored as NULL
+    def finite_or_none(value):
+        return value if value != float("inf") else None
+
+    for i, profile in enumerate(profiles):
+        for j, stop in enumerate(profile["stops"].tolist()):
+            travel_time = float(profile["first_time"][j])
+
+            attributes = [
+                len(features) + 1,
+                i + 1,
+                timetable.stop_ids[stop],
+                timetable.stop_names[stop],
+                finite_or_none(travel_time),
+                format_gtfs_time(departure_time + travel_time * 60)
+                if travel_time != float("inf")
+                else None,
+            ]
+            if last_departure_time is not None:
+                attributes += [
+                    finite_or_none(float(profile["min_time"][j])),
+                    finite_or_none(float(profile["median_time"][j])),
+                    finite_or_none(float(profile["percentile_time"][j])),
+                    float(profile["reachable_share"][j]),
+                ]
+
+            new_feature = QgsFeature(fields)
+            new_feature.setGeometry(
+                QgsGeometry.fromPointXY(QgsPointXY(stops_x[stop], stops_y[stop]))
+            )
+            new_feature.setAttributes(attributes)
+            features.append(new_feature)
+            feature_origins.append(i)
+
+    reachable_stops_layer, added_features = create_memory_layer(
+        "Point", crs, f"service_area_stops_{number_analysis}", fields, features
+    )
+
+    selected_id = defaultdict(list)
+    for i, feature in zip(feature_origins, added_features):
+        selected_id[i].append(feature.id())
+
+    change_style_layer(reachable_stops_layer, "circle", "lavander", "1.5", None)
+
+    QgsProject.instance().addMapLayer(reachable_stops_layer)
+
+    return reachable_stops_layer, selected_id
+
+
 def create_and_load_layer_starting_points(
     crs: QgsCoordinateReferenceSystem,
     nearest_nodes: list,
@@ -576,28 +800,24 @@ def create_and_load_layer_starting_points(
     fields.append(QgsField("Lat", QVariant.Double))
     fields.append(QgsField("Lon", QVariant.Double))
 
-    starting_points_layer = QgsVectorLayer(
-        "Point?crs=" + crs.authid(), f"starting_points_{number_analysis}", "memory"
-    )
-
-    starting_points_layer.dataProvider().addAttributes(fields)
-    starting_points_layer.startEditing()
-
+    features = []
     for point in nearest_nodes:
-        x_coord = G.nodes[point]["x"]
-        y_coord = G.nodes[point]["y"]
+        x_coord = float(G.graph["node_x"][point])
+        y_coord = float(G.graph["node_y"][point])
 
         starting_point = QgsPointXY(x_coord, y_coord)
         starting_point_geometry = QgsGeometry.fromPointXY(starting_point)
 
         # create a new feature
-        new_feature = QgsFeature(starting_points_layer.fields())
+        new_feature = QgsFeature(fields)
         new_feature.setGeometry(starting_point_geometry)
         new_feature.setAttributes([x_coord, y_coord])
 
-        starting_points_layer.addFeature(new_feature)
+        features.append(new_feature)
 
-    starting_points_layer.commitChanges()
+    starting_points_layer, _ = create_memory_layer(
+        "Point", crs, f"starting_points_{number_analysis}", fields, features
+    )
 
     change_style_layer(starting_points_layer, "square", "blue", "2", None)
 
@@ -618,35 +838,33 @@ def create_and_load_layer_starting_stops(
     fields.append(QgsField("Stop_name", QVariant.String))
     fields.append(QgsField("Transports", QVariant.String))
 
-    starting_stops_layer = QgsVectorLayer(
-        "Point?crs=" + crs.authid(), f"starting_stops_{number_analysis}", "memory"
-    )
+    features = []
 
-    starting_stops_layer.dataProvider().addAttributes(fields)
-    starting_stops_layer.startEditing()
+    stops_transports = Database().select_transports_by_stop_ids(
+        stop[0] for stop in nearest_stops
+    )
 
     for stop in nearest_stops:
         stop_id = stop[0]
         stop_name = stop[1]
         stop_point = stop[2]
 
-        current_stop_transports = Database().select_transports_by_stop_id(stop_id)
-        current_stop_transports_list = [
-            transport[0] for transport in current_stop_transports
-        ]
+        current_stop_transports_list = sorted(stops_transports[stop_id])
 
         transports_list.append(current_stop_transports_list)
         transports_string = ", ".join(current_stop_transports_list)
 
         # create a new feature
-        new_feature = QgsFeature(starting_stops_layer.fields())
+        new_feature = QgsFeature(fields)
         stop_geometry = QgsGeometry.fromPointXY(stop_point)
         new_feature.setGeometry(stop_geometry)
         new_feature.setAttributes([stop_id, stop_name, transports_string])
 
-        starting_stops_layer.addFeature(new_feature)
+        features.append(new_feature)
 
-    starting_stops_layer.commitChanges()
+    starting_stops_layer, _ = create_memory_layer(
+        "Point", crs, f"starting_stops_{number_analysis}", fields, features
+    )
 
     change_style_layer(starting_stops_layer, "square", "blue", "2", None)
 
@@ -675,18 +893,21 @@ def create_debug_layer():
     fields.append(QgsField("Latitude", QVariant.Double))
     fields.append(QgsField("Longitude", QVariant.Double))
 
-    # create a layer to store the points
-    points_layer = QgsVectorLayer("Point?crs=EPSG:4326", "debug_points", "memory")
-    points_layer.dataProvider().addAttributes(fields)
-    points_layer.startEditing()
-
     # create a new feature
+    features = []
     for point in points:
-        new_feature = QgsFeature(points_layer.fields())
+        new_feature = QgsFeature(fields)
         new_feature.setGeometry(QgsGeometry.fromPointXY(point))
-        points_layer.addFeature(new_feature)
+        features.append(new_feature)
 
-    points_layer.commitChanges()
+    # create a layer to store the points
+    points_layer, _ = create_memory_layer(
+        "Point",
+        QgsCoordinateReferenceSystem("EPSG:4326"),
+        "debug_points",
+        fields,
+        features,
+    )
 
     change_style_layer(points_layer, "square", "red", "2", None)
 
@@ -0,0 +1,340 @@
+""" Graph searches over compact CSR adjacency arrays. The module does not depend on QGIS so it can run in worker processes. """
+
+import heapq
+import os
+
+import numpy as np
+import networkx as nx
+from scipy.sparse import csr_matrix
+
+# arrays of a CSRGraph written to disk to be memory-mapped by the worker processes
+SHARED_ARRAYS = ("indptr", "indices", "weights")
+
+
+class CSRGraph:
+    """Directed graph stored as CSR arrays: the edges leaving node `i` are in `indptr[i]:indptr[i + 1]`"""
+
+    def __init__(self, nodes: list, indptr, indices, weights, keys=None):
+        self.nodes = nodes
+        self.node_index = {node: i for i, node in enumerate(nodes)}
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.keys = keys
+
+    @classmethod
+    def from_networkx(cls, G: nx.MultiDiGraph, weight: str, dtype=np.float64):
+        """Build the CSR arrays of `G` in a single pass over its edges, nodes keep the order of `G.nodes`"""
+
+        nodes = list(G.nodes)
+        node_index = {node: i for i, node in enumerate(nodes)}
+
+        sources, targets, keys, weights = [], [], [], []
+        for u, v, key, value in G.edges(keys=True, data=weight):
+            sources.append(node_index[u])
+            targets.append(node_index[v])
+            keys.append(key)
+            weights.append(value)
+
+        sources = np.array(sources, dtype=np.int64)
+        order = np.argsort(sources, kind="stable")
+        indptr = np.concatenate(
+            ([0], np.cumsum(np.bincount(sources, minlength=len(nodes))))
+        ).astype(np.int64)
+
+        return cls(
+            nodes,
+            indptr,
+            np.array(targets, dtype=np.int64)[order],
+            np.array(weights, dtype=dtype)[order],
+            np.array(keys, dtype=np.int64)[order],
+        )
+
+    @classmethod
+    def cached(cls, G: nx.MultiDiGraph, weight: str):
+        """CSR arrays of `G` weighted by `weight`, built at the first call and kept in `G.graph`"""
+
+        name = "csr_" + weight
+        if name not in G.graph:
+            G.graph[name] = cls.from_networkx(G, weight)
+
+        return G.graph[name]
+
+    @property
+    def arrays(self) -> tuple:
+        """Arrays needed by the searches of this module"""
+
+        return self.indptr, self.indices, self.weights
+
+    def edge_sources(self):
+        """Starting node of each edge, in the order of the CSR arrays"""
+
+        return np.repeat(np.arange(len(self.nodes)), np.diff(self.indptr))
+
+    def save_shared_arrays(self, folder: str):
+        """Write the arrays as .npy files that the worker processes map read-only in memory"""
+
+        for name, array in zip(SHARED_ARRAYS, self.arrays):
+            np.save(os.path.join(folder, name + ".npy"), array)
+
+
+def load_shared_arrays(folder: str) -> tuple:
+    """Memory-map the arrays written by `CSRGraph.save_shared_arrays`"""
+
+    return tuple(
+        np.load(os.path.join(folder, name + ".npy"), mmap_mode="r")
+        for name in SHARED_ARRAYS
+    )
+
+
+def bounded_dijkstra(
+    graph_arrays: tuple, source: int, cutoff: float, targets: set = None
+) -> dict:
+    """Distances of the nodes settled from `source` within `cutoff`.
+    The search stops as soon as all the `targets` are settled."""
+
+    indptr, indices, weights = graph_arrays
+
+    distances = {}
+    remaining = set(targets) if targets is not None else None
+    heap = [(0.0, source)]
+    tentative = {source: 0.0}
+
+    while heap:
+        distance, node = heapq.heappop(heap)
+        if node in distances:
+            continue
+        distances[node] = distance
+
+        if remaining is not None:
+            remaining.discard(node)
+            if not remaining:
+                break
+
+        start, end = indptr[node], indptr[node + 1]
+        for next_node, weight in zip(
+            indices[start:end].tolist(), weights[start:end].tolist()
+        ):
+            next_distance = distance + weight
+            if next_distance > cutoff or next_node in distances:
+                continue
+            if next_distance < tentative.get(next_node, np.inf):
+                tentative[next_node] = next_distance
+                heapq.heappush(heap, (next_distance, next_node))
+
+    return distances
+
+
+def shortest_path_tree(
+    graph_arrays: tuple, source: int, cutoff: float = np.inf, targets: set = None
+) -> tuple:
+    """Distances from `source` and the (previous node, edge) that reaches each settled node.
+    The search stops at `cutoff` or as soon as all the `targets` are settled."""
+
+    indptr, indices, weights = graph_arrays
+
+    distances = {}
+    predecessors = {}
+    remaining = set(targets) if targets is not None else None
+    heap = [(0.0, source, -1, -1)]
+    tentative = {source: 0.0}
+
+    while heap:
+        distance, node, previous_node, edge = heapq.heappop(heap)
+        if node in distances:
+            continue
+        distances[node] = distance
+        if edge >= 0:
+            predecessors[node] = (previous_node, edge)
+
+        if remaining is not None:
+            remaining.discard(node)
+            if not remaining:
+                break
+
+        start, end = int(indptr[node]), int(indptr[node + 1])
+        for next_edge, next_node, weight in zip(
+            range(start, end), indices[start:end].tolist(), weights[start:end].tolist()
+        ):
+            next_distance = distance + weight
+            if next_distance > cutoff or next_node in distances:
+                continue
+            if next_distance < tentative.get(next_node, np.inf):
+                tentative[next_node] = next_distance
+                heapq.heappush(heap, (next_distance, next_node, node, next_edge))
+
+    return distances, predecessors
+
+
+def tree_path(predecessors: dict, target: int) -> tuple:
+    """Nodes and edges of the path from the root of a shortest path tree to `target`"""
+
+    nodes = [target]
+    edges = []
+    while target in predecessors:
+        target, edge = predecessors[target]
+        nodes.append(target)
+        edges.append(edge)
+
+    return nodes[::-1], edges[::-1]
+
+
+def multi_source_bounded_dijkstra(
+    graph_arrays: tuple, sources: list, cutoff: float
+) -> csr_matrix:
+    """Distances within `cutoff` from each source as a sparse sources x nodes matrix.
+    The searches share the adjacency lists and the scratch buffers, which are reset
+    only where the previous search touched them. The source itself is stored as an explicit 0."""
+
+    # converted once for all the sources, list indexing is faster than array indexing
+    indptr, indices, weights = (array.tolist() for array in graph_arrays)
+    nodes_number = len(indptr) - 1
+
+    best = [np.inf] * nodes_number
+    settled = bytearray(nodes_number)
+    touched = []
+
+    row_indptr = [0]
+    columns = []
+    values = []
+
+    for source in sources:
+        best[source] = 0.0
+        touched.append(source)
+        heap = [(0.0, source)]
+
+        while heap:
+            distance, node = heapq.heappop(heap)
+            if settled[node]:
+                continue
+            settled[node] = 1
+            columns.append(node)
+            values.append(distance)
+
+            for edge in range(indptr[node], indptr[node + 1]):
+                next_distance = distance + weights[edge]
+                if next_distance > cutoff:
+                    continue
+                next_node = indices[edge]
+                if next_distance < best[next_node] and not settled[next_node]:
+                    if best[next_node] == np.inf:
+                        touched.append(next_node)
+                    best[next_node] = next_distance
+                    heapq.heappush(heap, (next_distance, next_node))
+
+        for node in touched:
+            best[node] = np.inf
+            settled[node] = 0
+        touched.clear()
+
+        row_indptr.append(len(columns))
+
+    return csr_matrix(
+        (
+            np.array(values, dtype=np.float64),
+            np.array(columns, dtype=np.int64),
+            np.array(row_indptr, dtype=np.int64),
+        ),
+        shape=(len(sources), nodes_number),
+    )
+
+
+def edges_within_cutoff(graph_arrays: tuple, nodes, distances, cutoff: float):
+    """Positions of the edges leaving `nodes`, reached at `distances`, that end within `cutoff`.
+    Return the edge positions and the position of their starting node"""
+
+    indptr, _, weights = graph_arrays
+    nodes = np.asarray(nodes, dtype=np.int64)
+
+    starts = indptr[nodes]
+    counts = indptr[nodes + 1] - starts
+    # position of every edge leaving the nodes, without a Python loop over the nodes
+    edges = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(
+        counts.sum()
+    )
+    arrivals = np.repeat(np.asarray(distances), counts) + weights[edges]
+    within_cutoff = arrivals <= cutoff
+
+    return edges[within_cutoff], np.repeat(nodes, counts)[within_cutoff]
+
+
+def connected_component_labels(nodes_number: int, sources, targets):
+    """Weakly connected component of each node, numbered from 0 by decreasing size,
+    with a union-find pass over the edge arrays"""
+
+    parents = list(range(nodes_number))
+
+    def find(node):
+        while parents[node] != node:
+            # path halving keeps the trees flat
+            parents[node] = parents[parents[node]]
+            node = parents[node]
+        return node
+
+    for u, v in zip(np.asarray(sources).tolist(), np.asarray(targets).tolist()):
+        root_u, root_v = find(u), find(v)
+        if root_u != root_v:
+            parents[root_u] = root_v
+
+    roots = np.array([find(node) for node in range(nodes_number)], dtype=np.int64)
+
+    # components renumbered so that the biggest one is 0
+    _, components, sizes = np.unique(roots, return_inverse=True, return_counts=True)
+    ranks = np.empty(len(sizes), dtype=np.int64)
+    ranks[np.argsort(-sizes, kind="stable")] = np.arange(len(sizes))
+
+    return ranks[components.reshape(-1)]
+
+
+def compute_transfers(graph_arrays: tuple, tasks: list, cutoff: float) -> list:
+    """Walking distance between each source stop and its nearby stops.
+    Each task is (source_stop, source_node, [(target_node, target_stop), ...]),
+    the result is a list of (source_stop, target_stop, distance)."""
+
+    transfers = []
+    for source_stop, source_node, stop_targets in tasks:
+        distances = bounded_dijkstra(
+            graph_arrays,
+            source_node,
+            cutoff,
+            targets={target_node for target_node, _ in stop_targets},
+        )
+
+        for target_node, target_stop in stop_targets:
+            if target_node in distances:
+                transfers.append((source_stop, target_stop, distances[target_node]))
+
+    return transfers
+
+
+# arrays mapped by each worker process of the transfers pool
+_worker_graph_arrays = None
+
+
+def init_transfers_worker(folder: str):
+    """Initializer of the worker processes: map the shared graph arrays once"""
+
+    global _worker_graph_arrays
+    _worker_graph_arrays = load_shared_arrays(folder)
+
+
+def compute_transfers_worker(arguments: tuple) -> list:
+    """Compute the transfers of a chunk of tasks in a worker process"""
+
+    tasks, cutoff = arguments
+    return compute_transfers(_worker_graph_arrays, tasks, cutoff)
+
+
+def spatial_chunks(tasks: list, x, y, chunks_number: int, cell_size: float) -> list:
+    """Split the tasks in chunks of nearby stops, `x[i]`/`y[i]` are the coordinates of the i-th task"""
+
+    cells = np.column_stack(
+        (np.floor(np.asarray(y) / cell_size), np.floor(np.asarray(x) / cell_size))
+    )
+    order = np.lexsort((cells[:, 1], cells[:, 0]))
+
+    return [
+        [tasks[i] for i in chunk]
+        for chunk in np.array_split(order, chunks_number)
+        if len(chunk)
+    ]
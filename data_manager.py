@@ -2,6 +2,7 @@ from qgis.core import QgsProject
 from qgis.utils import iface
 
 from .resources import *
+from .gtfs_db import Database
 
 import os
 import shutil
@@ -73,6 +74,9 @@ def delete_all_project_folders():
 
     folders_to_remove = ["graphs", "shapefiles", "polygons", "GTFS_DB"]
 
+    # release the pooled read connections before deleting the database
+    Database.close_all_connections()
+
     for folder in folders_to_remove:
         folder_path = os.path.join(os.path.dirname(__file__), folder)
         if os.path.exists(folder_path):
@@ -155,6 +159,8 @@ def remove_cached_graphs():
     cache_file_names = [
         "pedestrian_graph.gpkg",
         "pedestrian_graph.graphml.xml",
+        "pedestrian_graph.cache.npz",
+        "pedestrian_graph.index.pkl",
     ]
 
     for cache_file_name in cache_file_names:
@@ -0,0 +1,383 @@
+""" Binary cache of the graphs, stored next to the GraphML files to avoid parsing the XML at every session. """
+
+import io
+import json
+import os
+import pickle
+from contextlib import contextmanager
+
+import numpy as np
+import networkx as nx
+import osmnx as ox
+
+from .spatial_index import HaversineIndex
+
+# increase when the layout of the cache changes, old caches are then ignored
+CACHE_VERSION = 3
+
+# attributes stored in the cache for each graph
+ROUTES_NODE_ATTRIBUTES = {
+    "x": np.float64,
+    "y": np.float64,
+    "is_stop": np.bool_,
+    "stop_id": str,
+    "shape_id": str,
+}
+ROUTES_EDGE_ATTRIBUTES = {"weight": np.float64, "transport": str, "route_type": np.int64}
+WALK_NODE_ATTRIBUTES = {"x": np.float64, "y": np.float64}
+WALK_EDGE_ATTRIBUTES = {"length": np.float64}
+
+# value used when a node or an edge does not have the attribute
+MISSING_VALUES = {np.float64: np.nan, np.bool_: False, np.int64: -1, str: ""}
+
+# size of the chunks read from disk between two progress updates
+READ_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def graph_cache_path(graphml_path: str) -> str:
+    """Path of the binary cache associated to a GraphML file"""
+
+    return graphml_path.replace(".graphml.xml", ".cache.npz")
+
+
+def save_graph_cache(
+    G: nx.MultiDiGraph,
+    graphml_path: str,
+    node_attributes: dict,
+    edge_attributes: dict,
+    node_type: type = None,
+    node_ids=None,
+):
+    """Save the graph `G` as CSR adjacency arrays, coordinate arrays and an id table next to its GraphML file.
+    The id table stores `node_ids` if given, the nodes themselves otherwise"""
+
+    print("Saving graph cache...")
+
+    nodes = list(G.nodes)
+    node_index = {node: i for i, node in enumerate(nodes)}
+
+    arrays = {
+        "version": np.array(CACHE_VERSION),
+        # the size and modification time of the GraphML file identify the graph the cache was built from
+        "source_size": np.array(os.path.getsize(graphml_path)),
+        "source_mtime": np.array(os.path.getmtime(graphml_path)),
+        "graph_attributes": np.array(json.dumps(_serializable_attributes(G.graph))),
+    }
+
+    if node_ids is not None:
+        arrays["node_ids"] = np.asarray(node_ids)
+    elif node_type is not None:
+        arrays["node_ids"] = np.array([node_type(node) for node in nodes])
+    else:
+        arrays["node_ids"] = np.array(nodes)
+
+    for attribute, dtype in node_attributes.items():
+        missing = MISSING_VALUES[dtype]
+        arrays["node_attribute_" + attribute] = np.array(
+            [data.get(attribute, missing) for _, data in G.nodes(data=True)],
+            dtype=dtype,
+        )
+
+    # edges are sorted by starting node to build the CSR adjacency arrays
+    edges = list(G.edges(keys=True, data=True))
+    sources = np.array([node_index[u] for u, _, _, _ in edges], dtype=np.int64)
+    order = np.argsort(sources, kind="stable")
+
+    arrays["indptr"] = np.concatenate(
+        ([0], np.cumsum(np.bincount(sources, minlength=len(nodes))))
+    ).astype(np.int64)
+    arrays["indices"] = np.array(
+        [node_index[v] for _, v, _, _ in edges], dtype=np.int64
+    )[order]
+    arrays["keys"] = np.array([key for _, _, key, _ in edges], dtype=np.int64)[order]
+
+    for attribute, dtype in edge_attributes.items():
+        missing = MISSING_VALUES[dtype]
+        arrays["edge_attribute_" + attribute] = np.array(
+            [data.get(attribute, missing) for _, _, _, data in edges], dtype=dtype
+        )[order]
+
+    # write to a temporary file first so that a broken cache is never left behind
+    cache_path = graph_cache_path(graphml_path)
+    temporary_path = cache_path.replace(".npz", ".tmp.npz")
+    np.savez(temporary_path, **arrays)
+    os.replace(temporary_path, cache_path)
+
+    # the snapping index of the previous graph is rebuilt at the next load
+    if os.path.exists(snapping_index_path(graphml_path)):
+        os.remove(snapping_index_path(graphml_path))
+
+    print("Graph cache saved!")
+
+
+def load_graph_cache(graphml_path: str, progress_callback=None, compact: bool = False):
+    """Load the graph cached next to `graphml_path`. Return None if the cache is missing or outdated"""
+
+    cache_path = graph_cache_path(graphml_path)
+    if not os.path.exists(cache_path) or not os.path.exists(graphml_path):
+        return None
+
+    try:
+        data = read_file(cache_path, progress_callback)
+        with np.load(io.BytesIO(data), allow_pickle=False) as cache:
+            if (
+                int(cache["version"]) != CACHE_VERSION
+                or int(cache["source_size"]) != os.path.getsize(graphml_path)
+                or float(cache["source_mtime"]) != os.path.getmtime(graphml_path)
+            ):
+                print("Graph cache outdated")
+                return None
+
+            arrays = {name: cache[name] for name in cache.files}
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Error while reading the graph cache: {e}")
+        return None
+
+    return graph_from_arrays(arrays, compact)
+
+
+def graph_from_arrays(arrays: dict, compact: bool = False) -> nx.MultiDiGraph:
+    """Build a MultiDiGraph from the arrays of a graph cache.
+    With `compact` the nodes are the integers 0..n-1 and their attributes stay in the arrays of `G.graph`"""
+
+    G = nx.MultiDiGraph()
+    G.graph.update(json.loads(str(arrays["graph_attributes"])))
+
+    node_attributes = [
+        name[len("node_attribute_") :]
+        for name in arrays
+        if name.startswith("node_attribute_")
+    ]
+
+    if compact:
+        nodes = list(range(len(arrays["node_ids"])))
+        G.add_nodes_from(nodes)
+        G.graph["node_labels"] = arrays["node_ids"]
+        for name in node_attributes:
+            G.graph["node_" + name] = arrays["node_attribute_" + name]
+    else:
+        nodes = arrays["node_ids"].tolist()
+        node_columns = [
+            arrays["node_attribute_" + name].tolist() for name in node_attributes
+        ]
+        G.add_nodes_from(
+            (node, dict(zip(node_attributes, values)))
+            for node, *values in zip(nodes, *node_columns)
+        )
+
+    indptr = arrays["indptr"]
+    sources = np.repeat(np.arange(len(nodes)), np.diff(indptr)).tolist()
+    targets = arrays["indices"].tolist()
+    keys = arrays["keys"].tolist()
+
+    edge_attributes = [
+        name[len("edge_attribute_") :]
+        for name in arrays
+        if name.startswith("edge_attribute_")
+    ]
+    edge_columns = [arrays["edge_attribute_" + name].tolist() for name in edge_attributes]
+    G.add_edges_from(
+        (nodes[u], nodes[v], key, dict(zip(edge_attributes, values)))
+        for u, v, key, *values in zip(sources, targets, keys, *edge_columns)
+    )
+
+    return G
+
+
+def load_routes_graph(graphml_path: str, progress_callback=None) -> nx.MultiDiGraph:
+    """Load the routes graph from its binary cache, parsing the GraphML file only if the cache is missing.
+    The graph is compact: integer nodes with their attributes in the arrays of `G.graph`"""
+
+    G = load_graph_cache(graphml_path, progress_callback, compact=True)
+
+    if G is None:
+        G = compact_routes_graph(
+            nx.read_graphml(
+                io.BytesIO(read_file(graphml_path, progress_callback)),
+                force_multigraph=True,
+            )
+        )
+        with routes_graph_node_attributes(G) as node_arrays:
+            save_graph_cache(
+                G,
+                graphml_path,
+                ROUTES_NODE_ATTRIBUTES,
+                ROUTES_EDGE_ATTRIBUTES,
+                node_ids=node_arrays["node_labels"],
+            )
+
+    G.graph["snapping_index"] = load_snapping_index(
+        graphml_path, range(len(G)), G.graph["node_x"], G.graph["node_y"]
+    )
+
+    return G
+
+
+def compact_routes_graph(G: nx.MultiDiGraph) -> nx.MultiDiGraph:
+    """Relabel the nodes of the routes graph as the integers 0..n-1 and move their attributes
+    in the arrays G.graph["node_<attribute>"]. The original labels are kept in G.graph["node_labels"]"""
+
+    nodes = list(G.nodes)
+    if nodes != list(range(len(nodes))):
+        G = nx.relabel_nodes(G, {node: i for i, node in enumerate(nodes)})
+
+    G.graph["node_labels"] = np.array([str(node) for node in nodes])
+    for attribute, dtype in ROUTES_NODE_ATTRIBUTES.items():
+        missing = MISSING_VALUES[dtype]
+        values = [data.get(attribute, missing) for _, data in G.nodes(data=True)]
+        # text attributes stay as objects so that they can be changed in place
+        G.graph["node_" + attribute] = np.array(
+            values, dtype=object if dtype is str else dtype
+        )
+
+    for _, data in G.nodes(data=True):
+        data.clear()
+
+    return G
+
+
+@contextmanager
+def routes_graph_node_attributes(G: nx.MultiDiGraph):
+    """Temporarily copy the node arrays of a compact routes graph in the node attributes,
+    as expected by the GraphML, GeoPackage and cache writers. Yield the node arrays"""
+
+    arrays = {
+        name: G.graph.pop(name)
+        for name in list(G.graph)
+        if name.startswith("node_")
+    }
+
+    for attribute in ROUTES_NODE_ATTRIBUTES:
+        values = arrays["node_" + attribute].tolist()
+        for node, data in G.nodes(data=True):
+            data[attribute] = values[node]
+
+    try:
+        yield arrays
+    finally:
+        for _, data in G.nodes(data=True):
+            data.clear()
+        G.graph.update(arrays)
+
+
+def load_pedestrian_graph(graphml_path: str, progress_callback=None) -> nx.MultiDiGraph:
+    """Load the pedestrian graph from its binary cache, parsing the GraphML file only if the cache is missing"""
+
+    G_walk = load_graph_cache(graphml_path, progress_callback)
+
+    if G_walk is None:
+        G_walk = ox.load_graphml(
+            graphml_str=read_file(graphml_path, progress_callback).decode("utf-8"),
+            node_dtypes={"fid": int, "osmid": str, "x": float, "y": float},
+            edge_dtypes={
+                "fid": int,
+                "u": str,
+                "v": str,
+                "key": int,
+                "weight": float,
+                "transport": str,
+                "from": str,
+                "to": str,
+            },
+        )
+        save_graph_cache(
+            G_walk, graphml_path, WALK_NODE_ATTRIBUTES, WALK_EDGE_ATTRIBUTES
+        )
+
+    G_walk.graph["snapping_index"] = load_snapping_index(
+        graphml_path,
+        list(G_walk.nodes),
+        [x for _, x in G_walk.nodes(data="x")],
+        [y for _, y in G_walk.nodes(data="y")],
+    )
+
+    return G_walk
+
+
+def snapping_index_path(graphml_path: str) -> str:
+    """Path of the nearest node index saved next to the graph cache"""
+
+    return graphml_path.replace(".graphml.xml", ".index.pkl")
+
+
+def load_snapping_index(graphml_path: str, ids, x, y) -> HaversineIndex:
+    """Nearest node index of a graph, loaded from disk if it was built for the same graph,
+    otherwise built over the given nodes and saved for the next sessions"""
+
+    index_path = snapping_index_path(graphml_path)
+    source_size = os.path.getsize(graphml_path)
+    source_mtime = os.path.getmtime(graphml_path)
+    ids = list(ids)
+
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, "rb") as file:
+                state = pickle.load(file)
+            if (
+                state["version"] == CACHE_VERSION
+                and state["source_size"] == source_size
+                and state["source_mtime"] == source_mtime
+                and state["ids"] == ids
+            ):
+                return HaversineIndex(ids, state["x"], state["y"], tree=state["tree"])
+        except Exception as e:
+            # an index pickled by other numpy or scikit-learn versions is rebuilt
+            print(f"Error while reading the snapping index: {e}")
+
+    print("Building snapping index...")
+    index = HaversineIndex(ids, x, y)
+
+    state = {
+        "version": CACHE_VERSION,
+        "source_size": source_size,
+        "source_mtime": source_mtime,
+        "ids": ids,
+        "x": index.x,
+        "y": index.y,
+        "tree": index.tree,
+    }
+    temporary_path = index_path + ".tmp"
+    try:
+        with open(temporary_path, "wb") as file:
+            pickle.dump(state, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temporary_path, index_path)
+    except OSError as e:
+        print(f"Error while saving the snapping index: {e}")
+
+    return index
+
+
+def graph_file_size(graphml_path: str) -> int:
+    """Number of bytes read to load a graph, used to report the loading progress"""
+
+    cache_path = graph_cache_path(graphml_path)
+    if os.path.exists(cache_path):
+        return os.path.getsize(cache_path)
+
+    return os.path.getsize(graphml_path)
+
+
+def read_file(path: str, progress_callback=None) -> bytes:
+    """Read a whole file in chunks, calling `progress_callback` with the number of bytes of each chunk"""
+
+    chunks = []
+    with open(path, "rb") as file:
+        while True:
+            chunk = file.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            chunks.append(chunk)
+            if progress_callback is not None:
+                progress_callback(len(chunk))
+
+    return b"".join(chunks)
+
+
+def _serializable_attributes(attributes: dict) -> dict:
+    """Keep only the graph attributes that can be stored as JSON"""
+
+    return {
+        key: value
+        for key, value in attributes.items()
+        if isinstance(value, (str, int, float, bool))
+    }
@@ -2,10 +2,120 @@
 
 import sqlite3
 from sqlite3 import Error
+from pathlib import Path
+import threading
+import datetime
 import os
 
+# types of the known GTFS columns, the other columns of a feed are stored as TEXT
+GTFS_COLUMN_TYPES = {
+    "stops": {
+        "stop_id": "TEXT",
+        "stop_code": "TEXT",
+        "stop_name": "TEXT",
+        "stop_lat": "REAL",
+        "stop_lon": "REAL",
+        "location_type": "INTEGER",
+        "parent_station": "TEXT",
+        "wheelchair_boarding": "INTEGER",
+    },
+    "routes": {
+        "route_id": "TEXT",
+        "agency_id": "TEXT",
+        "route_short_name": "TEXT",
+        "route_long_name": "TEXT",
+        "route_type": "INTEGER",
+    },
+    "trips": {
+        "route_id": "TEXT",
+        "service_id": "TEXT",
+        "trip_id": "TEXT",
+        "trip_headsign": "TEXT",
+        "direction_id": "INTEGER",
+        "shape_id": "TEXT",
+    },
+    "stop_times": {
+        "trip_id": "TEXT",
+        "arrival_time": "TEXT",
+        "departure_time": "TEXT",
+        "stop_id": "TEXT",
+        "stop_sequence": "INTEGER",
+        "pickup_type": "INTEGER",
+        "drop_off_type": "INTEGER",
+        "shape_dist_traveled": "REAL",
+    },
+    "shapes": {
+        "shape_id": "TEXT",
+        "shape_pt_lat": "REAL",
+        "shape_pt_lon": "REAL",
+        "shape_pt_sequence": "INTEGER",
+        "shape_dist_traveled": "REAL",
+    },
+    "calendar": {
+        "service_id": "TEXT",
+        "monday": "INTEGER",
+        "tuesday": "INTEGER",
+        "wednesday": "INTEGER",
+        "thursday": "INTEGER",
+        "friday": "INTEGER",
+        "saturday": "INTEGER",
+        "sunday": "INTEGER",
+        "start_date": "TEXT",
+        "end_date": "TEXT",
+    },
+    "calendar_dates": {
+        "service_id": "TEXT",
+        "date": "TEXT",
+        "exception_type": "INTEGER",
+    },
+}
+
+# primary keys of the GTFS tables, the big tables are clustered on them
+GTFS_PRIMARY_KEYS = {
+    "stops": ("stop_id",),
+    "routes": ("route_id",),
+    "trips": ("trip_id",),
+    "stop_times": ("trip_id", "stop_sequence"),
+    "shapes": ("shape_id", "shape_pt_sequence"),
+    "calendar": ("service_id",),
+    "calendar_dates": ("service_id", "date"),
+}
+GTFS_WITHOUT_ROWID_TABLES = ("stop_times", "shapes")
+
+# covering indexes on the columns used by the joins of the Database queries
+GTFS_INDEXES = [
+    ("idx_stop_times_stop_id", "stop_times", ("stop_id", "trip_id")),
+    ("idx_trips_shape_id", "trips", ("shape_id", "route_id")),
+    ("idx_trips_route_id", "trips", ("route_id", "trip_id")),
+    ("idx_calendar_dates_date", "calendar_dates", ("date", "service_id")),
+]
+
+# columns of the calendar table, in the order of datetime.date.weekday()
+WEEKDAY_COLUMNS = (
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+)
+
+# maximum number of parameters bound to a single IN (...) query
+MAX_QUERY_PARAMETERS = 900
+
+# settings of the read-only connections used by the analyses
+READ_CACHED_STATEMENTS = 256
+READ_MMAP_SIZE = 1024 * 1024 * 1024
+READ_CACHE_SIZE_KB = 256 * 1024
+
 
 class Database:
+    # read-only connections shared by all the instances, one for each thread
+    _local = threading.local()
+    _connections = []
+    _connections_lock = threading.Lock()
+
     def __init__(self):
         self._FILE_DB = "GTFS_DB/gtfs.db"
         self._path = os.path.dirname(os.path.abspath(__file__)) + "/" + self._FILE_DB
@@ -16,25 +126,54 @@ class Database:
 
     def create_connection(self):
         """
-        create a database connection to the SQLite database specified by the db_file
-        :param db_file: database file
+        Return the read-only connection of the current thread, opening it the first time
         :return: Connection object or None
         """
-        conn = None
+        conn = getattr(Database._local, "conn", None)
+        if conn is not None:
+            return conn
+
         try:
-            conn = sqlite3.connect(self._path)
+            conn = sqlite3.connect(
+                Path(self._path).as_uri() + "?mode=ro",
+                uri=True,
+                check_same_thread=False,
+                cached_statements=READ_CACHED_STATEMENTS,
+            )
+            conn.execute(f"PRAGMA mmap_size = {READ_MMAP_SIZE}")
+            conn.execute(f"PRAGMA cache_size = -{READ_CACHE_SIZE_KB}")
+            conn.execute("PRAGMA temp_store = MEMORY")
         except Error as e:
             print(e)
+            return None
+
+        Database._local.conn = conn
+        with Database._connections_lock:
+            Database._connections.append(conn)
 
         return conn
 
-    def close_connection(self, conn):
+    @classmethod
+    def close_all_connections(cls):
         """
-        Close the connection with the database
-        :param conn: the Connection object
+        Close the pooled connections, needed before the database file is replaced or deleted
         :return:
         """
-        conn.close()
+        with cls._connections_lock:
+            for conn in cls._connections:
+                conn.close()
+            cls._connections.clear()
+            cls._local = threading.local()
+
+    def fetch_all(self, query: str, parameters: tuple = ()):
+        """
+        Run a query on the pooled connection and return all the rows
+        :param query: SQL query, its prepared statement is cached by the connection
+        :param parameters: parameters of the query
+        :return: list of rows
+        """
+        conn = self.create_connection()
+        return conn.execute(query, parameters).fetchall()
 
     def select_all_coordinates_stops(self):
         """
@@ -42,13 +181,8 @@ class Database:
         :param conn: the Connection object
         :return:
         """
-        conn = self.create_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops")
+        rows = self.fetch_all("SELECT stop_id, stop_name, stop_lat, stop_lon FROM stops")
 
-        rows = cur.fetchall()
-
-        self.close_connection(conn)
         return rows
 
     def select_all_coordinates_shapes(self):
@@ -57,15 +191,10 @@ class Database:
         :param conn: the Connection object
         :return:
         """
-        conn = self.create_connection()
-        cur = conn.cursor()
-        cur.execute(
+        rows = self.fetch_all(
             "SELECT shape_id, shape_pt_lat, shape_pt_lon, shape_pt_sequence FROM shapes"
         )
 
-        rows = cur.fetchall()
-
-        self.close_connection(conn)
         return rows
 
     def select_stop_coordinates_by_id(self, stop_id):
@@ -74,16 +203,11 @@ class Database:
         :param conn: the Connection object
         :return:
         """
-        conn = self.create_connection()
-        cur = conn.cursor()
-        cur.execute(
+        rows = self.fetch_all(
             "SELECT stop_lat, stop_lon, stop_name FROM stops WHERE stop_id = ?",
             (stop_id,),
         )
 
-        rows = cur.fetchall()
-
-        self.close_connection(conn)
         return rows
 
     def select_information_given_stop_id(self, stop_id):
@@ -92,10 +216,7 @@ class Database:
         :param conn: the Connection object
         :return:
         """
-        conn = self.create_connection()
-        cur = conn.cursor()
-
-        cur.execute(
+        rows = self.fetch_all(
             """
             SELECT st.trip_id, st.arrival_time, st.departure_time, st.stop_sequence,
                 tr.route_id, tr.service_id, tr.trip_headsign,
@@ -109,9 +230,6 @@ class Database:
             (stop_id,),
         )
 
-        rows = cur.fetchall()
-
-        self.close_connection(conn)
         return rows
 
     def select_transports_by_stop_id(self, stop_id):
@@ -120,10 +238,7 @@ class Database:
         :param conn: the Connection object
         :return:
         """
-        conn = self.create_connection()
-        cur = conn.cursor()
-
-        cur.execute(
+        rows = self.fetch_all(
             """
             SELECT DISTINCT route_id
             FROM trips AS tr
@@ -133,20 +248,60 @@ class Database:
             (stop_id,),
         )
 
-        rows = cur.fetchall()
-
-        self.close_connection(conn)
         return rows
 
+    def select_transports_by_stop_ids(self, stop_ids):
+        """
+        Query the routes passing by each of the given stops
+        :param stop_ids: iterable of stop_id
+        :return: dict mapping every stop_id to a frozenset of route_id
+        """
+        stop_ids = list(set(stop_ids))
+        transports = {stop_id: set() for stop_id in stop_ids}
+
+        # the precomputed table is missing in databases imported by older versions
+        if self.has_table("stop_routes"):
+            query = """
+                SELECT stop_id, route_id
+                FROM stop_routes
+                WHERE stop_id IN ({})
+                """
+        else:
+            query = """
+                SELECT DISTINCT st.stop_id, tr.route_id
+                FROM stop_times AS st
+                JOIN trips AS tr ON st.trip_id = tr.trip_id
+                WHERE st.stop_id IN ({})
+                """
+
+        for i in range(0, len(stop_ids), MAX_QUERY_PARAMETERS):
+            chunk = stop_ids[i : i + MAX_QUERY_PARAMETERS]
+            rows = self.fetch_all(query.format(", ".join(["?"] * len(chunk))), chunk)
+            for stop_id, route_id in rows:
+                transports[stop_id].add(route_id)
+
+        return {stop_id: frozenset(routes) for stop_id, routes in transports.items()}
+
+    def has_table(self, table_name: str) -> bool:
+        """
+        Check if a table exists in the database
+        :param table_name: name of the table
+        :return: True if the table exists
+        """
+        rows = self.fetch_all(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (table_name,),
+        )
+
+        return bool(rows)
+
     def select_transport_by_shape_id(self, shape_id):
         """
         Query
         :param conn: the Connection object
         :return:
         """
-        conn = self.create_connection()
-        cur = conn.cursor()
-        cur.execute(
+        rows = self.fetch_all(
             """
             SELECT DISTINCT tr.route_id, ro.route_type
             FROM trips AS tr
@@ -157,25 +312,168 @@ class Database:
             (shape_id,),
         )
 
-        rows = cur.fetchall()
-
-        self.close_connection(conn)
         return rows
 
+    def select_transports_by_shape_ids(self):
+        """
+        Query the route_id and route_type of every shape with a single grouped query
+        :return: dict mapping shape_id to a (route_id, route_type) tuple
+        """
+        conn = self.create_connection()
+        # MIN() makes SQLite take the bare route_type from the same row
+        cur = conn.execute(
+            """
+            SELECT tr.shape_id, MIN(tr.route_id), ro.route_type
+            FROM trips AS tr
+            JOIN routes AS ro ON tr.route_id = ro.route_id
+            WHERE tr.shape_id IS NOT NULL AND tr.shape_id != ''
+            GROUP BY tr.shape_id
+            """
+        )
+
+        transports = {row[0]: (row[1], row[2]) for row in cur}
+
+        return transports
+
+    def iterate_ordered_shapes(self):
+        """
+        Stream all rows of the shapes table ordered by shape and point sequence
+        :return: generator of (shape_id, shape_pt_lat, shape_pt_lon, shape_pt_sequence)
+        """
+        conn = self.create_connection()
+        # a dedicated cursor streams the rows without materialising them
+        cur = conn.execute(
+            """
+            SELECT shape_id, shape_pt_lat, shape_pt_lon, shape_pt_sequence
+            FROM shapes
+            ORDER BY shape_id, shape_pt_sequence
+            """
+        )
+        yield from cur
+
+    def iterate_ordered_stop_times(self):
+        """
+        Stream the times of every stop event ordered by trip and stop sequence
+        :return: generator of (trip_id, stop_id, arrival_time, departure_time)
+        """
+        conn = self.create_connection()
+        cur = conn.execute(
+            """
+            SELECT trip_id, stop_id, arrival_time, departure_time
+            FROM stop_times
+            ORDER BY trip_id, stop_sequence
+            """
+        )
+        yield from cur
+
+    def select_active_trip_ids(self, service_date: str):
+        """
+        Query the trips running on a service date, following calendar and calendar_dates
+        :param service_date: date in the GTFS format YYYYMMDD
+        :return: set of trip_id, None if the feed has no calendar and every trip is kept
+        """
+        has_calendar = self.has_table("calendar")
+        has_calendar_dates = self.has_table("calendar_dates")
+        if not has_calendar and not has_calendar_dates:
+            return None
+
+        service_ids = set()
+        if has_calendar:
+            weekday = WEEKDAY_COLUMNS[
+                datetime.datetime.strptime(service_date, "%Y%m%d").weekday()
+            ]
+            rows = self.fetch_all(
+                f"""
+                SELECT service_id
+                FROM calendar
+                WHERE {weekday} = 1 AND start_date <= ? AND end_date >= ?
+                """,
+                (service_date, service_date),
+            )
+            service_ids.update(row[0] for row in rows)
+
+        if has_calendar_dates:
+            rows = self.fetch_all(
+                "SELECT service_id, exception_type FROM calendar_dates WHERE date = ?",
+                (service_date,),
+            )
+            for service_id, exception_type in rows:
+                # 1: service added for the date, 2: service removed for the date
+                if exception_type == 1:
+                    service_ids.add(service_id)
+                elif exception_type == 2:
+                    service_ids.discard(service_id)
+
+        rows = self.fetch_all("SELECT trip_id, service_id FROM trips")
+
+        return {trip_id for trip_id, service_id in rows if service_id in service_ids}
+
     def select_all_stops_id(self):
         """
         Query all rows in the stops table
         :param conn: the Connection object
         :return:
         """
-        conn = self.create_connection()
-        cur = conn.cursor()
-        cur.execute("SELECT stop_id FROM stops")
+        rows = self.fetch_all("SELECT stop_id FROM stops")
 
-        rows = cur.fetchall()
-
-        self.close_connection(conn)
         return rows
 
 
+def create_table_statement(table_name: str, header: list) -> str:
+    """Build the typed CREATE TABLE statement of a GTFS table given the CSV header"""
+
+    column_types = GTFS_COLUMN_TYPES.get(table_name, {})
+    columns = [
+        f'"{column}" {column_types.get(column, "TEXT")}' for column in header
+    ]
+
+    # the primary key is declared only if the feed provides all of its columns
+    primary_key = GTFS_PRIMARY_KEYS.get(table_name, ())
+    if primary_key and all(column in header for column in primary_key):
+        columns.append(f'PRIMARY KEY ({", ".join(primary_key)})')
+        if table_name in GTFS_WITHOUT_ROWID_TABLES:
+            return f'CREATE TABLE IF NOT EXISTS {table_name} ({", ".join(columns)}) WITHOUT ROWID'
+
+    return f'CREATE TABLE IF NOT EXISTS {table_name} ({", ".join(columns)})'
+
+
+def create_indexes(cursor: sqlite3.Cursor):
+    """Create the indexes on the join columns and update the statistics of the query planner"""
+
+    for index_name, table_name, columns in GTFS_INDEXES:
+        cursor.execute(f"PRAGMA table_info({table_name})")
+        table_columns = {row[1] for row in cursor.fetchall()}
+        if not all(column in table_columns for column in columns):
+            continue
+
+        cursor.execute(
+            f'CREATE INDEX IF NOT EXISTS {index_name} ON {table_name} ({", ".join(columns)})'
+        )
+
+    cursor.execute("ANALYZE")
+
+
+def create_stop_routes_table(cursor: sqlite3.Cursor):
+    """Materialize the routes passing by every stop, used by the batched stop lookups"""
+
+    cursor.execute(
+        """
+        CREATE TABLE IF NOT EXISTS stop_routes (
+            stop_id TEXT,
+            route_id TEXT,
+            PRIMARY KEY (stop_id, route_id)
+        ) WITHOUT ROWID
+        """
+    )
+    cursor.execute(
+        """
+        INSERT OR IGNORE INTO stop_routes
+        SELECT DISTINCT st.stop_id, tr.route_id
+        FROM stop_times AS st
+        JOIN trips AS tr ON st.trip_id = tr.trip_id
+        """
+    )
+    cursor.execute("ANALYZE stop_routes")
+
+
 database = Database()
@@ -6,22 +6,73 @@ from qgis.PyQt.QtWidgets import (
     QProgressDialog,
 )
 
-from qgis.core import QgsApplication
+from qgis.core import QgsApplication, QgsTask
 
 from .resources import *
 
 from .service_area_analysis import *
 from .nearby_stops_paths_analysis import *
 from .multi_analysis import *
+from .graph_cache import load_routes_graph, load_pedestrian_graph, graph_file_size
+from .utils import add_travel_times
 # from .key_points_analysis import *
 
-import networkx as nx
-import osmnx as ox
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
 
 G = None
 G_WALK = None
 
 
+def load_routes_graph_with_travel_times(graphml_path: str, progress_callback=None):
+    """Load the routes graph and compute the travel time of its edges once"""
+
+    return add_travel_times(load_routes_graph(graphml_path, progress_callback))
+
+
+class GraphLoaderTask(QgsTask):
+    """Task that loads the graphs in parallel worker threads, reporting the bytes read as progress"""
+
+    def __init__(self, graphs_to_load: dict):
+        """`graphs_to_load` maps the name of each graph to its (loader, graphml_path)"""
+
+        super().__init__("Loading graphs")
+        self.graphs_to_load = graphs_to_load
+        self.graphs = {}
+        self.exception = None
+
+        self._bytes_read = 0
+        self._lock = threading.Lock()
+
+    def run(self):
+        """Load the graphs, this method runs in a background thread"""
+
+        try:
+            total_bytes = sum(
+                graph_file_size(path) for _, path in self.graphs_to_load.values()
+            )
+
+            def on_bytes_read(bytes_read):
+                with self._lock:
+                    self._bytes_read += bytes_read
+                    progress = 100 * self._bytes_read / max(total_bytes, 1)
+                self.setProgress(min(progress, 99))
+
+            with ThreadPoolExecutor(max_workers=len(self.graphs_to_load)) as executor:
+                futures = {
+                    executor.submit(loader, path, on_bytes_read): name
+                    for name, (loader, path) in self.graphs_to_load.items()
+                }
+                for future in as_completed(futures):
+                    self.graphs[futures[future]] = future.result()
+        except Exception as e:
+            self.exception = e
+            return False
+
+        self.setProgress(100)
+        return True
+
+
 class Inputs:
     def select_analysis_type(self):
         """Create a dialog that ask the user with 3 different buttons which analysis he wants to do and put a comment beside each button explaining what the analysis does"""
@@ -67,77 +118,138 @@ class Inputs:
                 and not self.nearby_stops_checkbox.isChecked()
                 # and not self.interoperability_checkbox.isChecked()
             ):
-                start_service_area_analysis(self, dialog, *self.load_graphs())
+                self.load_graphs(
+                    lambda G, G_walk: start_service_area_analysis(
+                        self, dialog, G, G_walk
+                    )
+                )
             if (
                 self.nearby_stops_checkbox.isChecked()
                 and not self.service_area_checkbox.isChecked()
                 # and not self.interoperability_checkbox.isChecked()
             ):
-                start_nearby_stops_paths_analysis(self, dialog, *self.load_graphs())
+                self.load_graphs(
+                    lambda G, G_walk: start_nearby_stops_paths_analysis(
+                        self, dialog, G, G_walk
+                    )
+                )
             if (
                 self.service_area_checkbox.isChecked()
                 and self.nearby_stops_checkbox.isChecked()
                 # and not self.interoperability_checkbox.isChecked()
             ):
-                start_multi_analysis(self, dialog, *self.load_graphs())
+                self.load_graphs(
+                    lambda G, G_walk: start_multi_analysis(self, dialog, G, G_walk)
+                )
             # if (
             #     self.interoperability_checkbox.isChecked()
             #     and not self.nearby_stops_checkbox.isChecked()
             #     and not self.service_area_checkbox.isChecked()
             # ):
-            #     start_key_points_analysis(self, dialog, *self.load_graphs())
+            #     self.load_graphs(
+            #         lambda G, G_walk: start_key_points_analysis(self, dialog, G, G_walk)
+            #     )
         else:
             return
 
-    def load_graphs(self):
+    def load_graphs(self, on_graphs_loaded):
+        """Load the graphs in a background task and call `on_graphs_loaded(G, G_walk)` when both are ready"""
+
+        if G is not None and G_WALK is not None:
+            on_graphs_loaded(G, G_WALK)
+            return
+
+        if getattr(self, "graph_loader_task", None) is not None:
+            # the analysis starts as soon as the graphs being loaded are ready
+            self.graphs_loaded_callbacks.append(on_graphs_loaded)
+            iface.messageBar().pushMessage(
+                "Info",
+                "Graphs are still loading, the analysis will start when they are ready",
+                level=Qgis.Info,
+                duration=5,
+            )
+            return
+
         print("Loading graphs...")
-        # create a progressive bar
+
+        GRAPH_PATH_GML_WALK = self._path + "/graphs/pedestrian_graph.graphml.xml"
+        GRAPH_PATH_GML_ROUTE = self._path + "/graphs/routes_graph.graphml.xml"
+
+        # load only the graphs that are not in memory yet
+        graphs_to_load = {}
+        if G_WALK is None:
+            graphs_to_load["G_walk"] = (load_pedestrian_graph, GRAPH_PATH_GML_WALK)
+        if G is None:
+            graphs_to_load["G"] = (
+                load_routes_graph_with_travel_times,
+                GRAPH_PATH_GML_ROUTE,
+            )
+
+        # the progress dialog is not modal so that QGIS stays responsive
         self.progress_dialog = QProgressDialog(iface.mainWindow())
         self.progress_dialog.setWindowTitle("Loading Graphs")
         self.progress_dialog.setLabelText("Loading graphs...")
         self.progress_dialog.setCancelButton(None)
         self.progress_dialog.setMinimumDuration(0)
-        self.progress_dialog.setWindowModality(2)  # Finestra modale
 
         self.progress_bar = QProgressBar(self.progress_dialog)
         self.progress_bar.setMinimum(0)
         self.progress_bar.setMaximum(100)
 
         self.progress_dialog.setBar(self.progress_bar)
+        self.progress_dialog.show()
 
-        global G, G_WALK
+        task = GraphLoaderTask(graphs_to_load)
+        task.progressChanged.connect(
+            lambda progress: self.progress_bar.setValue(int(progress))
+        )
+        task.taskCompleted.connect(lambda: self.on_graphs_loaded(task))
+        task.taskTerminated.connect(lambda: self.on_graphs_loading_failed(task))
 
-        GRAPH_PATH_GML_WALK = self._path + "/graphs/pedestrian_graph.graphml.xml"
-        GRAPH_PATH_GML_ROUTE = self._path + "/graphs/routes_graph.graphml.xml"
+        # keep a reference to the task until it has finished
+        self.graph_loader_task = task
+        self.graphs_loaded_callbacks = [on_graphs_loaded]
+        QgsApplication.taskManager().addTask(task)
 
-        self.progress_dialog.show()
+    def on_graphs_loaded(self, task):
+        """Store the loaded graphs and start the analyses requested while loading"""
 
-        for i in range(51):
-            self.progress_bar.setValue(i)
-            QgsApplication.processEvents()
-
-            G_WALK = G_WALK or ox.load_graphml(
-                GRAPH_PATH_GML_WALK,
-                node_dtypes={"fid": int, "osmid": str, "x": float, "y": float},
-                edge_dtypes={
-                    "fid": int,
-                    "u": str,
-                    "v": str,
-                    "key": int,
-                    "weight": float,
-                    "transport": str,
-                    "from": str,
-                    "to": str,
-                },
-            )
+        global G, G_WALK
 
-        for i in range(51, 101):
-            self.progress_bar.setValue(i * 2)
-            G = G or nx.read_graphml(GRAPH_PATH_GML_ROUTE)
+        # the graphs were reset while this task was running, they are stale
+        if task is not getattr(self, "graph_loader_task", None):
+            return
+
+        G = task.graphs.get("G", G)
+        G_WALK = task.graphs.get("G_walk", G_WALK)
+
+        callbacks = self.graphs_loaded_callbacks
+        self.graph_loader_task = None
+        self.graphs_loaded_callbacks = []
+        self.progress_dialog.close()
 
         print("Graphs loaded")
+        for on_graphs_loaded in callbacks:
+            on_graphs_loaded(G, G_WALK)
+
+    def on_graphs_loading_failed(self, task):
+        """Notify the user that the graphs could not be loaded"""
+
+        # the task was cancelled by reset_graphs
+        if task is not getattr(self, "graph_loader_task", None):
+            return
+
+        self.graph_loader_task = None
+        self.graphs_loaded_callbacks = []
         self.progress_dialog.close()
-        return G, G_WALK
+
+        print(f"Error while loading the graphs: {task.exception}")
+        iface.messageBar().pushMessage(
+            "Error",
+            "Graphs could not be loaded",
+            level=Qgis.Critical,
+            duration=5,
+        )
 
     def reset_graphs(self):
         """Update the graphs"""
@@ -145,3 +257,11 @@ class Inputs:
         global G, G_WALK
         G = None
         G_WALK = None
+
+        # cancel the graphs being loaded and the analyses waiting for them
+        task = getattr(self, "graph_loader_task", None)
+        if task is not None:
+            self.graph_loader_task = None
+            self.graphs_loaded_callbacks = []
+            task.cancel()
+            self.progress_dialog.close()
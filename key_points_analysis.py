@@ -21,6 +21,7 @@ from qgis.core import (
     QgsCoordinateReferenceSystem,
     QgsFeature,
     QgsVectorLayer,
+    QgsSpatialIndex,
 )
 
 from qgis.utils import iface
@@ -365,20 +366,16 @@ def create_and_load_layer_starting_key_point(
     fields.append(QgsField("ID", QVariant.Int))
     fields.append(QgsField("Function", QVariant.String))
 
-    starting_key_point_layer = QgsVectorLayer(
-        "Point?crs=" + crs.authid(), f"starting_key_points_{number_analysis}", "memory"
-    )
-
-    starting_key_point_layer.dataProvider().addAttributes(fields)
-    starting_key_point_layer.startEditing()
-
+    features = []
     for key_point in nearest_key_point:
-        feature = QgsFeature()
+        feature = QgsFeature(fields)
         feature.setGeometry(QgsGeometry.fromPointXY(key_point[2]))
         feature.setAttributes([key_point[0], key_point[1]])
-        starting_key_point_layer.dataProvider().addFeatures([feature])
+        features.append(feature)
 
-    starting_key_point_layer.commitChanges()
+    starting_key_point_layer, _ = create_memory_layer(
+        "Point", crs, f"starting_key_points_{number_analysis}", fields, features
+    )
 
     change_style_layer(starting_key_point_layer, "square", "blue", "2", None)
 
@@ -413,12 +410,7 @@ def create_and_load_layer_selected_key_points(
         key_point_id_list,
     ) = ([], [], [], [])
 
-    selected_key_points_layer = QgsVectorLayer(
-        "Point?crs=" + crs.authid(), f"selected_key_points_{number_analysis}", "memory"
-    )
-
-    selected_key_points_layer.dataProvider().addAttributes(fields)
-    selected_key_points_layer.startEditing()
+    features = []
 
     key_point_index = QgsSpatialIndex(points_layer.getFeatures())
 
@@ -437,7 +429,7 @@ def create_and_load_layer_selected_key_points(
             key_point_id_list.append(point_feature.id())
 
             if circular_buffer.contains(point_geometry):
-                feature = QgsFeature(selected_key_points_layer.fields())
+                feature = QgsFeature(fields)
                 feature.setGeometry(point_geometry)
 
                 # if the column with the attribute is equal to the attribute of the starting key point, then it is a selected key point
@@ -467,13 +459,15 @@ def create_and_load_layer_selected_key_points(
                     selected_key_points_dict[starting_key_point_id].append(
                         [feature.id(), feature[f"starting_{attribute}"], key_point]
                     )
-                selected_key_points_layer.dataProvider().addFeatures([feature])
+                features.append(feature)
 
         total_key_points_list.append(selected_key_points + discarded_key_points)
         selected_key_points_list.append(selected_key_points)
         discarded_key_points_list.append(discarded_key_points)
 
-    selected_key_points_layer.commitChanges()
+    selected_key_points_layer, _ = create_memory_layer(
+        "Point", crs, f"selected_key_points_{number_analysis}", fields, features
+    )
 
     change_style_layer(selected_key_points_layer, "square", "yellow", "2", None)
 
@@ -545,41 +539,37 @@ def create_and_load_layer_circular_buffer_key_point(
     fields.append(QgsField("Selected Key Points", QVariant.Int))
     fields.append(QgsField("Discarded Key Points", QVariant.Int))
 
-    circular_buffer_layer = QgsVectorLayer(
-        "Polygon?crs=" + crs.authid(), f"circular_buffer_{number_analysis}", "memory"
-    )
-
-    circular_buffer_layer.dataProvider().addAttributes(fields)
-    circular_buffer_layer.startEditing()
-
-    for circular_buffer, key_point_id, total_key_points, selected_key_points, discarded_key_points in zip(
+    features = []
+    for buffer_id, (circular_buffer, key_point_id, total_key_points, selected_key_points, discarded_key_points) in enumerate(zip(
         circular_buffer_list, key_point_id_list, total_key_points_list, selected_key_points_list, discarded_key_points_list
-    ):
-        feature = QgsFeature()
+    )):
+        feature = QgsFeature(fields)
         feature.setGeometry(circular_buffer)
         feature.setAttributes(
             [
-                circular_buffer_list.index(circular_buffer),
+                buffer_id,
                 key_point_id,
                 total_key_points,
                 selected_key_points,
                 discarded_key_points,
             ]
         )
-        circular_buffer_layer.dataProvider().addFeatures([feature])
-
-        fill_symbol = QgsFillSymbol.createSimple(
-            {
-                "color": "cyan",
-                "outline_color": "black",
-                "outline_width": "0.5",
-                "style": "solid",
-            }
-        )
+        features.append(feature)
 
-        fill_symbol.setColor(QColor(0, 255, 255, 80))
-        circular_buffer_layer.renderer().setSymbol(fill_symbol)
+    circular_buffer_layer, _ = create_memory_layer(
+        "Polygon", crs, f"circular_buffer_{number_analysis}", fields, features
+    )
+
+    fill_symbol = QgsFillSymbol.createSimple(
+        {
+            "color": "cyan",
+            "outline_color": "black",
+            "outline_width": "0.5",
+            "style": "solid",
+        }
+    )
 
-    circular_buffer_layer.commitChanges()
+    fill_symbol.setColor(QColor(0, 255, 255, 80))
+    circular_buffer_layer.renderer().setSymbol(fill_symbol)
 
     project.addMapLayer(circular_buffer_layer)
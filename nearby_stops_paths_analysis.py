@@ -6,6 +6,7 @@ from qgis.PyQt.QtWidgets import (
     QDialog,
     QVBoxLayout,
     QLabel,
+    QCheckBox,
     QDialogButtonBox,
     QComboBox,
     QCompleter,
@@ -16,9 +17,10 @@ from qgis.core import (
     QgsProject,
     QgsWkbTypes,
     QgsMapLayer,
-    QgsSpatialIndex,
     Qgis,
     QgsCoordinateReferenceSystem,
+    QgsFeatureRequest,
+    QgsVectorLayer,
 )
 
 from qgis.utils import iface
@@ -38,7 +40,7 @@ def get_inputs_from_dialog_nearby_stops_paths(inputs):
     dialog.setWindowTitle("Nearby Stops Paths Analysis")
 
     layout = QVBoxLayout()
-    dialog.setFixedSize(400, 175)
+    dialog.setFixedSize(400, 200)
 
     label = QLabel("Insert the stop layer you want to analyse")
     layout.addWidget(label)
@@ -78,6 +80,11 @@ def get_inputs_from_dialog_nearby_stops_paths(inputs):
     inputs.range_line_edit.setValidator(QIntValidator(100, 2000))
     layout.addWidget(inputs.range_line_edit)
 
+    # the buffer polygons are not needed by the analysis, they are only drawn
+    inputs.draw_buffers_checkbox = QCheckBox("Draw the circular buffers")
+    inputs.draw_buffers_checkbox.setChecked(True)
+    layout.addWidget(inputs.draw_buffers_checkbox)
+
     dialog.setLayout(layout)
 
     # create the button box
@@ -110,7 +117,7 @@ def get_inputs_from_dialog_nearby_stops_paths(inputs):
     # managing errors
     handle_service_area_input_errors(range)
 
-    return points, int(range)
+    return points, int(range), inputs.draw_buffers_checkbox.isChecked()
 
 
 def handle_service_area_input_errors(range):
@@ -135,7 +142,7 @@ def start_nearby_stops_paths_analysis(
         starting_dialog.close()
 
     try:
-        points, range = get_inputs_from_dialog_nearby_stops_paths(inputs)
+        points, range, draw_buffers = get_inputs_from_dialog_nearby_stops_paths(inputs)
     except TypeError:
         return
 
@@ -144,74 +151,91 @@ def start_nearby_stops_paths_analysis(
     number_analysis = get_number_analysis()
 
     nearby_stops_paths_analysis_operations(
-        inputs, crs, points, range, G_walk, number_analysis
+        inputs, crs, points, range, G_walk, number_analysis, draw_buffers
     )
 
 
-def find_intersections(inputs, number_analysis: int):
-    """Find the intersections between the pedestrian graph and the shortest paths"""
+def pedestrian_edges_features(pedestrian_graph_layer: QgsVectorLayer) -> tuple:
+    """Feature id of each (u, v, key) edge of the pedestrian graph layer, and of each (u, v) pair.
+    Ids are compared as strings, only the attributes are read"""
+
+    field_names = ["u", "v", "key"]
+    request = QgsFeatureRequest()
+    request.setFlags(QgsFeatureRequest.NoGeometry)
+    request.setSubsetOfAttributes(field_names, pedestrian_graph_layer.fields())
+
+    edge_features = {}
+    pair_features = {}
+    for feature in pedestrian_graph_layer.getFeatures(request):
+        u, v, key = (str(feature[name]) for name in field_names)
+        edge_features[(u, v, key)] = feature.id()
+        pair_features.setdefault((u, v), feature.id())
+
+    return edge_features, pair_features
+
+
+def find_intersections(inputs, number_analysis: int, paths_edges: list):
+    """Count how many times the shortest paths use each street of the pedestrian graph,
+    `paths_edges` holds the (u, v, key) edges of each path"""
 
     LAYER_NAME_PEDESTRIAN_GRAPH = "pedestrian_graph"
-    LAYER_NAME_SHORTEST_PATH = f"shortest_paths_{number_analysis}"
 
     project = QgsProject.instance()
     pedestrian_graph_layer = project.mapLayersByName(LAYER_NAME_PEDESTRIAN_GRAPH)[0]
-    shortest_path_layer = project.mapLayersByName(LAYER_NAME_SHORTEST_PATH)[0]
 
     fields = QgsFields()
     fields.append(QgsField("osmid", QVariant.String))
     fields.append(QgsField("name", QVariant.String))
     fields.append(QgsField("intersection_count", QVariant.Int))
 
-    intersections_layer = QgsVectorLayer(
-        "LineString?crs=epsg:4326", f"intersections_{number_analysis}", "memory"
+    edge_features, pair_features = pedestrian_edges_features(pedestrian_graph_layer)
+
+    # the layer is saved undirected, so an edge can be stored in the opposite direction
+    # and its key can be renumbered when the two directions have different geometries
+    feature_counts = defaultdict(int)
+    for path_edges in paths_edges:
+        for u, v, key in path_edges:
+            u, v, key = str(u), str(v), str(key)
+            feature_id = edge_features.get((u, v, key))
+            if feature_id is None:
+                feature_id = edge_features.get((v, u, key))
+            if feature_id is None:
+                feature_id = pair_features.get((u, v), pair_features.get((v, u)))
+            if feature_id is not None:
+                feature_counts[feature_id] += 1
+
+    # geometry, street name and number of intersections of each osmid
+    intersections = {}
+
+    request = QgsFeatureRequest().setFilterFids(list(feature_counts))
+    for pedestrian_graph_feature in pedestrian_graph_layer.getFeatures(request):
+        osmid = pedestrian_graph_feature["osmid"]
+        count = feature_counts[pedestrian_graph_feature.id()]
+
+        if osmid in intersections:
+            intersections[osmid][2] += count
+        else:
+            intersections[osmid] = [
+                pedestrian_graph_feature.geometry(),
+                pedestrian_graph_feature["name"],
+                count,
+            ]
+
+    features = []
+    for osmid, (geometry, street_name, count) in intersections.items():
+        feature = QgsFeature(fields)
+        feature.setGeometry(geometry)
+        feature.setAttributes([osmid, street_name, count])
+        features.append(feature)
+
+    intersections_layer, _ = create_memory_layer(
+        "LineString",
+        QgsCoordinateReferenceSystem("EPSG:4326"),
+        f"intersections_{number_analysis}",
+        fields,
+        features,
     )
-    intersections_layer.dataProvider().addAttributes(fields)
-    intersections_layer.updateFields()
 
-    # create a spatial index for the pedestrian graph layer (the bigger one)
-    pedestrian_graph_index = QgsSpatialIndex(pedestrian_graph_layer.getFeatures())
-
-    for shortest_path_feature in shortest_path_layer.getFeatures():
-        shortest_path_geometry = shortest_path_feature.geometry()
-        intersecting_pedestrian_graph_ids = pedestrian_graph_index.intersects(
-            shortest_path_geometry.boundingBox()
-        )
-
-        for pedestrian_graph_id in intersecting_pedestrian_graph_ids:
-            pedestrian_graph_feature = pedestrian_graph_layer.getFeature(pedestrian_graph_id)
-            pedestrian_graph_geometry = pedestrian_graph_feature.geometry()
-
-            if shortest_path_geometry.touches(pedestrian_graph_geometry) \
-            or shortest_path_geometry.intersects(pedestrian_graph_geometry) \
-            or shortest_path_geometry.crosses(pedestrian_graph_geometry) \
-            or shortest_path_geometry.overlaps(pedestrian_graph_geometry) \
-            or shortest_path_geometry.contains(pedestrian_graph_geometry) \
-            or shortest_path_geometry.within(pedestrian_graph_geometry):
-                osmid = pedestrian_graph_feature["osmid"]
-                street_name = pedestrian_graph_feature["name"]
-
-                found_intersection = None
-                for intersection in intersections_layer.getFeatures():
-                    if intersection["osmid"] == osmid:
-                        found_intersection = intersection
-                        break
-
-                if found_intersection is not None:
-                    intersections_layer.startEditing()
-                    intersections_layer.changeAttributeValue(
-                        found_intersection.id(),
-                        2,
-                        found_intersection["intersection_count"] + 1,
-                    )
-                    intersections_layer.commitChanges()
-                else:
-                    feature = QgsFeature(fields)
-                    feature.setGeometry(pedestrian_graph_geometry)
-                    feature.setAttributes([osmid, street_name, 1])
-                    intersections_layer.dataProvider().addFeatures([feature])
-
-    intersections_layer.updateExtents()
     project.addMapLayer(intersections_layer)
 
 
@@ -222,6 +246,7 @@ def nearby_stops_paths_analysis_operations(
     range: int,
     G_walk: nx.MultiDiGraph,
     number_analysis: int,
+    draw_buffers: bool = True,
 ):
     """Operations for nearby stops analysis"""
     progress_bar = QProgressDialog()
@@ -233,23 +258,23 @@ def nearby_stops_paths_analysis_operations(
     progress_bar.setWindowModality(2)
     progress_bar.setValue(0)
 
-    # create a spatial index for the stops layer (the bigger one)
-    stops_layer = QgsProject.instance().mapLayersByName("stops")[0]
-    stops_index = QgsSpatialIndex(stops_layer.getFeatures())
-
     progress_bar.show()
     QApplication.processEvents()
 
-    nearest_stop_ids = []
-    for point in points:
-        nearest_stop = stops_index.nearestNeighbor(point, 1)[0]
-        stop_feature = stops_layer.getFeature(nearest_stop)
-        current_stop_id = stop_feature["ID"]
-        current_stop_name = stop_feature["Stop_name"]
-        current_stop_point = stop_feature.geometry().asPoint()
-        nearest_stop_ids.append(
-            [current_stop_id, current_stop_name, current_stop_point]
-        )
+    # nearest stop of every point, with the stops index cached for the database
+    stops_index, stop_names = load_stops_index()
+    nearest_positions, _ = stops_index.nearest(
+        [point.x() for point in points], [point.y() for point in points]
+    )
+
+    nearest_stop_ids = [
+        [
+            stops_index.ids[position],
+            stop_names[position],
+            QgsPointXY(stops_index.x[position], stops_index.y[position]),
+        ]
+        for position in nearest_positions.tolist()
+    ]
 
     transport_list = create_and_load_layer_starting_stops(
         crs, nearest_stop_ids, number_analysis
@@ -257,38 +282,36 @@ def nearby_stops_paths_analysis_operations(
 
     progress_bar.setValue(20)
 
-    circular_buffer_list = calculate_circular_buffers(
-        nearest_stop_ids, stops_layer, range
-    )
-
-    progress_bar.setValue(40)
-
     (
         nearest_stops_information,
         selected_stops_dict,
         selected,
     ) = create_and_load_layer_selected_stops(
         crs,
-        stops_layer,
-        circular_buffer_list,
+        range,
         transport_list,
         nearest_stop_ids,
         number_analysis,
     )
 
-    create_and_load_layer_circular_buffer(
-        crs, nearest_stops_information, number_analysis
-    )
+    progress_bar.setValue(40)
+
+    if draw_buffers:
+        circular_buffer_list = calculate_circular_buffers(nearest_stop_ids, crs, range)
+
+        create_and_load_layer_circular_buffer(
+            crs, circular_buffer_list, nearest_stops_information, number_analysis
+        )
 
     progress_bar.setValue(60)
 
     if selected:
-        create_and_load_layer_shortest_paths(
-            crs, nearest_stop_ids, selected_stops_dict, G_walk, number_analysis
+        paths_edges = create_and_load_layer_shortest_paths(
+            crs, nearest_stop_ids, selected_stops_dict, G_walk, number_analysis, range
         )
 
         progress_bar.setValue(80)
 
-        find_intersections(inputs, number_analysis)
+        find_intersections(inputs, number_analysis, paths_edges)
 
     progress_bar.setValue(100)
@@ -6,6 +6,7 @@ from shapely.geometry import Polygon
 import os.path
 
 from .utils import change_style_layer
+from .graph_cache import WALK_NODE_ATTRIBUTES, WALK_EDGE_ATTRIBUTES, save_graph_cache
 
 import osmnx as ox
 
@@ -64,6 +65,14 @@ class PedestrianGraph:
             pedestrian_graph, filepath=GRAPH_PATH_GPKG, directed=False
         )
         ox.save_graphml(pedestrian_graph, filepath=GRAPH_PATH_GML)
+        # node ids are stored as strings, like when the GraphML file is loaded
+        save_graph_cache(
+            pedestrian_graph,
+            GRAPH_PATH_GML,
+            WALK_NODE_ATTRIBUTES,
+            WALK_EDGE_ATTRIBUTES,
+            node_type=str,
+        )
 
         print("Pedestrian graph created!")
 
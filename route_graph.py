@@ -3,27 +3,56 @@ from qgis.core import (
     QgsProject,
     QgsVectorLayer,
     QgsFeature,
-    QgsRectangle,
     QgsGeometry,
     QgsPointXY,
     QgsField,
-    QgsSpatialIndex,
 )
 
 from .resources import *
 import os.path
 
 from .gtfs_db import Database
-from .utils import change_style_layer
+from .utils import change_style_layer, get_python_executable
+from .spatial_index import HaversineIndex, haversine_distances
+from .csr_graph import (
+    CSRGraph,
+    connected_component_labels,
+    compute_transfers,
+    compute_transfers_worker,
+    init_transfers_worker,
+    spatial_chunks,
+)
+from .graph_cache import (
+    ROUTES_NODE_ATTRIBUTES,
+    ROUTES_EDGE_ATTRIBUTES,
+    save_graph_cache,
+    load_pedestrian_graph,
+    routes_graph_node_attributes,
+)
 
-from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import multiprocessing
+import tempfile
+import numpy as np
 import networkx as nx
 import osmnx as ox
 import datetime
 
-EARTH_CIRCUMFERENCE_DIVIDED_BY_360 = 111320
-RADIUS = 400 / EARTH_CIRCUMFERENCE_DIVIDED_BY_360
-STOP_RADIUS = 100 / EARTH_CIRCUMFERENCE_DIVIDED_BY_360
+STOP_RADIUS_METERS = 100
+# shape points closer than this on both axes become the same node of the routes graph
+NODE_MERGE_TOLERANCE_DEGREES = 1e-7
+TRANSFER_RADIUS_METERS = 400
+
+# processes used to compute the walking edges between the stops, 1 to compute them in QGIS
+TRANSFER_WORKERS = os.cpu_count() or 1
+# below this number of stops starting the processes costs more than the searches
+PARALLEL_TRANSFERS_MIN_STOPS = 2000
+# stops are split in chunks of nearby stops so that each process reads a compact part of the graph
+TRANSFER_CHUNKS_PER_WORKER = 4
+TRANSFER_CHUNK_CELL_DEGREES = 0.01
+
+# above this number of edges the layer of the subgraphs is not created
+SUBGRAPHS_LAYER_MAX_EDGES = 500000
 
 
 class RouteGraph:
@@ -47,66 +76,79 @@ class RouteGraph:
         print("Creating graph for routes...")
 
         database = Database()
-        shapes = database.select_all_coordinates_shapes()
+        # resolve route_id and route_type of every shape in one query
+        transports = database.select_transports_by_shape_ids()
 
-        if not shapes:
+        if not transports:
             return "Error: routes is empty"
 
-        shape_id = ""
-        is_first_value = True
+        # shape points are streamed already ordered by shape_id and sequence,
+        # the points of the shapes not used by any trip are skipped
+        shape_ids, xs, ys = [], [], []
+        for shape in database.iterate_ordered_shapes():
+            if shape[0] not in transports:
+                continue
+            shape_ids.append(shape[0])
+            xs.append(float(shape[2]))
+            ys.append(float(shape[1]))
+
+        xs = np.array(xs, dtype=np.float64)
+        ys = np.array(ys, dtype=np.float64)
+        shape_codes = np.array(shape_ids, dtype=object)
+
+        # points in the same cell of the tolerance grid become the same node, with a compact integer id
+        cells = np.column_stack(
+            (
+                np.round(xs / NODE_MERGE_TOLERANCE_DEGREES),
+                np.round(ys / NODE_MERGE_TOLERANCE_DEGREES),
+            )
+        ).astype(np.int64)
+        _, first_points, point_nodes = np.unique(
+            cells, axis=0, return_index=True, return_inverse=True
+        )
+        point_nodes = point_nodes.reshape(-1)
+
+        # consecutive points of the same shape are the edges, measured in a single pass
+        edge_starts = np.flatnonzero(
+            (shape_codes[:-1] == shape_codes[1:])
+            & (point_nodes[:-1] != point_nodes[1:])
+        )
+        distances = haversine_distances(
+            xs[edge_starts], ys[edge_starts], xs[edge_starts + 1], ys[edge_starts + 1]
+        )
 
         G = nx.MultiDiGraph()
         G.graph["crs"] = "EPSG:4326"
 
-        for shape in shapes:
-            # check if is the first value
-            if shape[0] != shape_id:
-                is_first_value = True
-
-            if is_first_value:
-                shape_id = shape[0]
-                is_first_value = False
-
-                transport_info = database.select_transport_by_shape_id(shape_id)
-                # the result is composed by one tuple and is composed by transport and route_type
-                transport = str(transport_info[0][0])
-                route_type = int(transport_info[0][1])
-
-                # update previous shape
-                prev_shape = shape
-
-                G.add_node(
-                    shape[0] + "_" + str(shape[3]),
-                    x=float(shape[2]),
-                    y=float(shape[1]),
-                    is_stop=False,
-                )
-            else:
-                G.add_node(
-                    shape[0] + "_" + str(shape[3]),
-                    x=float(shape[2]),
-                    y=float(shape[1]),
-                    is_stop=False,
-                )
-
-                # calculate euclidean distance between previous shape and current shape
-                euclidean_distance = ox.distance.great_circle_vec(
-                    float(prev_shape[2]), float(prev_shape[1]), float(shape[2]), float(shape[1])
-                )
-
-                starting_node = prev_shape[0] + "_" + str(prev_shape[3])
-                ending_node = shape[0] + "_" + str(shape[3])
-                G.add_edge(
-                    starting_node,
-                    ending_node,
-                    weight=euclidean_distance,
-                    transport=transport,
-                    route_type=route_type,
-                )
-
-                # update previous shape
-                prev_shape = shape
+        # the node attributes are arrays indexed by the node id, the shape and stop ids are the side table
+        nodes_number = len(first_points)
+        G.add_nodes_from(range(nodes_number))
+        G.graph["node_labels"] = np.arange(nodes_number)
+        G.graph["node_x"] = xs[first_points]
+        G.graph["node_y"] = ys[first_points]
+        G.graph["node_is_stop"] = np.zeros(nodes_number, dtype=bool)
+        G.graph["node_stop_id"] = np.full(nodes_number, "", dtype=object)
+        G.graph["node_shape_id"] = shape_codes[first_points]
+
+        # edge attributes are shared by all the edges of a shape
+        shape_attributes = {
+            shape_id: {
+                "transport": str(transport),
+                "route_type": int(route_type),
+            }
+            for shape_id, (transport, route_type) in transports.items()
+        }
+        G.add_edges_from(
+            (u, v, {"weight": distance, **shape_attributes[shape_ids[i]]})
+            for i, u, v, distance in zip(
+                edge_starts.tolist(),
+                point_nodes[edge_starts].tolist(),
+                point_nodes[edge_starts + 1].tolist(),
+                distances.tolist(),
+            )
+        )
 
+        print(len(xs), " shape points merged into ", len(G), " nodes")
         print("Graph created!")
 
         self.modify_graph(G)
@@ -117,11 +159,20 @@ class RouteGraph:
         if not os.path.exists(self._path + "/graphs"):
             os.makedirs(self._path + "/graphs")
 
-        # ox.save_graphml(G, filepath=graph_path_gml)
-        nx.write_graphml(G, GRAPH_PATH_GML)
-        print("Graph saved as GRAPHML file!")
-        ox.save_graph_geopackage(G, filepath=GRAPH_PATH_GPKG, directed=True)
-        print("Graph saved as GeoPackage file!")
+        # the writers expect the node attributes in the nodes
+        with routes_graph_node_attributes(G) as node_arrays:
+            # ox.save_graphml(G, filepath=graph_path_gml)
+            nx.write_graphml(G, GRAPH_PATH_GML)
+            print("Graph saved as GRAPHML file!")
+            save_graph_cache(
+                G,
+                GRAPH_PATH_GML,
+                ROUTES_NODE_ATTRIBUTES,
+                ROUTES_EDGE_ATTRIBUTES,
+                node_ids=node_arrays["node_labels"],
+            )
+            ox.save_graph_geopackage(G, filepath=GRAPH_PATH_GPKG, directed=True)
+            print("Graph saved as GeoPackage file!")
 
         # load graph as layer
         self.load_routes_layer(GRAPH_PATH_GPKG, "routes_graph")
@@ -145,71 +196,23 @@ class RouteGraph:
         change_style_layer(layer_line, None, "orange", None, "0.5")
 
     def modify_graph(self, G: nx.MultiDiGraph):
-        """Modifies the graph `G` by merging nodes with the same coordinates and merging stops with the graph."""
+        """Modifies the graph `G` by merging stops with the graph and connecting its subgraphs."""
 
         GRAPH_PATH_GML = self._path + "/graphs/pedestrian_graph.graphml.xml"
 
         print("Modifying graph...")
 
-        # Create a dictionary of coordinates
-        coords = defaultdict(list)
-        for node, data in G.nodes(data=True):
-            coords[(data["x"], data["y"])].append(node)
-
-        print("Merging nodes with same coordinates...")
-        for coord, nodes in coords.items():
-            if len(nodes) > 1:
-                self.merge_graph_nodes_with_same_coordinates(G, nodes, coord)
-        print("Nodes merged!")
-
         self.merge_stops_with_graph(G)
 
-        self.get_subgraphs(G)
-
-        G_walk = ox.load_graphml(
-            GRAPH_PATH_GML,
-            node_dtypes={"fid": int, "osmid": str, "x": float, "y": float},
-            edge_dtypes={
-                "fid": int,
-                "u": str,
-                "v": str,
-                "key": int,
-                "weight": float,
-                "transport": str,
-                "from": str,
-                "to": str,
-            },
-        )
+        G_walk = load_pedestrian_graph(GRAPH_PATH_GML)
         self.merge_subgraphs(G, G_walk)
 
         print("Graph modified!")
 
         self.get_subgraphs(G)
 
-    def merge_graph_nodes_with_same_coordinates(
-        self, G: nx.MultiDiGraph, nodes: list, coord: tuple
-    ):
-        """Merge the selected `nodes` in the graph `G` into one `new_node`, considering edge directions."""
-
-        # id of the new node is the concatenation of the ids of the merged nodes
-        node_id = "-".join(nodes)
-
-        G.add_node(node_id, x=coord[0], y=coord[1], is_stop=False)
-
-        for node in nodes:
-            edges_out = G.edges(node, data=True, keys=True)
-            edges_in = G.in_edges(node, data=True, keys=True)
-
-            for u, v, k, data in edges_out:
-                G.add_edge(node_id, v, key=k, **data)
-
-            for u, v, k, data in edges_in:
-                G.add_edge(u, node_id, key=k, **data)
-            G.remove_node(node)
-
     def merge_stops_with_graph(self, G: nx.MultiDiGraph):
         """Merges the stops with the graph."""
-        # Possible improvements: use a spatial index to speed up the process
 
         print("Merging stops with the graph...")
         print(len(G.nodes()), " nodes in the routes graph")
@@ -217,286 +220,191 @@ class RouteGraph:
         database = Database()
         stops = database.select_all_coordinates_stops()
 
-        feature_id_graph_to_point = defaultdict(dict)
-        point_to_id_graph = defaultdict(dict)
-
-        # create a spatial index of the graph
-        spatial_index_graph = QgsSpatialIndex()
-        sub_spatial_index_graph = QgsSpatialIndex()
-        for node, id in zip(G.nodes(), range(len(G.nodes()))):
-            x = float(G.nodes[node]["x"])
-            y = float(G.nodes[node]["y"])
-            point_graph = QgsPointXY(x, y)
-            point_to_id_graph[point_graph] = node
-
-            feature_graph = QgsFeature()
-            feature_graph.setGeometry(QgsGeometry.fromPointXY(point_graph))
-            feature_graph.setId(id)
-            spatial_index_graph.addFeature(feature_graph)
-            feature_id_graph_to_point[id] = point_graph
-
-        for stop in stops:
-            stop_point = QgsPointXY(float(stop[3]), float(stop[2]))
-
-            # define the dimensions of the bounding box
-            x_min = stop_point.x() - STOP_RADIUS
-            y_min = stop_point.y() - STOP_RADIUS
-            x_max = stop_point.x() + STOP_RADIUS
-            y_max = stop_point.y() + STOP_RADIUS
-
-            bounding_box = QgsRectangle(x_min, y_min, x_max, y_max)
-
-            intersecting_features = spatial_index_graph.intersects(bounding_box)
-
-            # create a sub spatial index
-            for feature in intersecting_features:
-                feature_graph = QgsFeature()
-                sub_point = feature_id_graph_to_point[feature]
-                feature_graph.setGeometry(QgsGeometry.fromPointXY(sub_point))
-                feature_graph.setId(feature)
-                sub_spatial_index_graph.addFeature(feature_graph)
-
-            nearest_node = sub_spatial_index_graph.nearestNeighbor(stop_point, 1, 0)[0]
-            nearest_point = feature_id_graph_to_point[nearest_node]
-            nearest_node_id = point_to_id_graph[nearest_point]
+        if not stops:
+            print("No stops found!")
+            return
 
-            G.nodes[nearest_node_id]["is_stop"] = True
-
-        print("Stops merged!")
-
-    def convert_nodes_into_points(self, G: nx.MultiDiGraph):
-        """Convert nodes into points"""
-
-        print("Converting stop nodes into points...")
-        print(len(G.nodes()), " nodes in the routes graph")
-
-        # create a default dictionary to store the nodes with the attribute id
-        point_to_id_stop = defaultdict(dict)
-        feature_id_stop_to_point = defaultdict(dict)
-
-        # create a spatial index
-        spatial_index_stops = QgsSpatialIndex()
-
-        stop_points = []
-
-        # create a list of points and fill a dictionary with the nodes with the attribute id
-        for node, id in zip(G.nodes, range(len(G.nodes))):
-            x = float(G.nodes[node]["x"])
-            y = float(G.nodes[node]["y"])
-            is_stop = G.nodes[node]["is_stop"]
-
-            if is_stop == True:
-                point = QgsPointXY(x, y)
-                point_to_id_stop[point] = node
-                stop_points.append(point)
-
-                feature_stop = QgsFeature()
-                feature_stop.setGeometry(QgsGeometry.fromPointXY(point))
-                feature_stop.setId(id)
-                spatial_index_stops.addFeature(feature_stop)
-                feature_id_stop_to_point[feature_stop.id()] = point
-
-        print("Stop nodes converted into points!")
-
-        return (
-            stop_points,
-            point_to_id_stop,
-            spatial_index_stops,
-            feature_id_stop_to_point,
+        # build the nearest neighbour index once over all the graph nodes
+        nodes_index = HaversineIndex(
+            range(len(G)), G.graph["node_x"], G.graph["node_y"]
         )
 
-    def convert_walk_nodes_into_points(self, G: nx.MultiDiGraph):
-        """Convert walk nodes into points"""
-
-        print("Converting walk nodes into points...")
-        print(len(G.nodes()), " nodes in the walk graph")
-
-        start_time = datetime.datetime.now()
-
-        point_to_id_walk = defaultdict(dict)
-        feature_id_walk_to_point = defaultdict(dict)
-
-        # create a spatial index
-        spatial_index_walk = QgsSpatialIndex()
-
-        for node, id in zip(G.nodes, range(len(G.nodes))):
-            x = float(G.nodes[node]["x"])
-            y = float(G.nodes[node]["y"])
-            point = QgsPointXY(x, y)
-            point_to_id_walk[point] = node
-
-            feature_walk = QgsFeature()
-            feature_walk.setGeometry(QgsGeometry.fromPointXY(point))
-            feature_walk.setId(id)
-            spatial_index_walk.addFeature(feature_walk)
-            feature_id_walk_to_point[feature_walk.id()] = point
+        # snap all the stops with a single batched query
+        nearest_nodes, distances = nodes_index.nearest(
+            [float(stop[3]) for stop in stops], [float(stop[2]) for stop in stops]
+        )
 
-        print("Walk nodes converted into points!")
+        is_stop = G.graph["node_is_stop"]
+        stop_ids = G.graph["node_stop_id"]
+        for stop, node, distance in zip(stops, nearest_nodes, distances):
+            # stops without a node of the routes nearby are not part of any shape
+            if distance <= STOP_RADIUS_METERS and not is_stop[node]:
+                is_stop[node] = True
+                stop_ids[node] = str(stop[0])
 
-        end_time = datetime.datetime.now()
-        print("Total operation time: ", end_time - start_time)
-
-        return point_to_id_walk, spatial_index_walk, feature_id_walk_to_point
+        print("Stops merged!")
 
     def merge_subgraphs(self, G: nx.MultiDiGraph, G_walk: nx.MultiDiGraph):
-        """Merge subgraphs"""
+        """Merge subgraphs connecting with a walking edge the stops within the transfer radius"""
 
         # Possible improvement: Provare a rimuovere gli archi a piedi fra i due punti collegandoli direttamente con il path reale. Per fare ció l'idea é quella di creare un
         # grafo secondario dove mettere solo le connessioni mentre in quello grande mettere lo shortest path.
 
         print("Merging subgraphs...")
 
-        (
-            stop_points,
-            point_to_id_stop,
-            spatial_index_stops,
-            feature_id_stop_to_point,
-        ) = self.convert_nodes_into_points(G)
-        (
-            point_to_id_walk,
-            spatial_index_walk,
-            feature_id_walk_to_point,
-        ) = self.convert_walk_nodes_into_points(G_walk)
+        stop_nodes = np.flatnonzero(G.graph["node_is_stop"]).tolist()
+        stops_x = G.graph["node_x"][stop_nodes]
+        stops_y = G.graph["node_y"][stop_nodes]
+        print(len(stop_nodes), " stops in the routes graph")
+
+        if not stop_nodes:
+            print("No points found!")
+            return
+
+        walk_graph = CSRGraph.from_networkx(G_walk, weight="length")
+        stops_index = HaversineIndex(stop_nodes, stops_x, stops_y)
+
+        # nearest walk node of every stop, with the snapping index persisted with the pedestrian graph,
+        # and nearby stops of every stop, in two batched queries
+        nearest_walk_positions = [
+            walk_graph.node_index[node]
+            for node in G_walk.graph["snapping_index"].nearest_ids(stops_x, stops_y)
+        ]
+        nearby_stops = stops_index.query_radius(
+            stops_x, stops_y, TRANSFER_RADIUS_METERS
+        )
 
         start_time = datetime.datetime.now()
         print("Start time: ", start_time)
 
-        for stop_point, i in zip(stop_points, range(len(stop_points))):
-            # define the rectangle area for the current stop point
-            x_min = stop_point.x() - RADIUS
-            y_min = stop_point.y() - RADIUS
-            x_max = stop_point.x() + RADIUS
-            y_max = stop_point.y() + RADIUS
-
-            rectangle_area = QgsRectangle(x_min, y_min, x_max, y_max)
-
-            intersected_stop_features = spatial_index_stops.intersects(rectangle_area)
-
-            if len(intersected_stop_features) > 0:
-                current_walk_point_feature_id = spatial_index_walk.nearestNeighbor(
-                    stop_point, 1, 0
-                )[
-                    0
-                ]  # return a list of ID ordered by distance
-
-                current_walk_point = feature_id_walk_to_point[
-                    current_walk_point_feature_id
-                ]
-
-                current_walk_point_id = point_to_id_walk[current_walk_point]
-                current_stop_point_id = point_to_id_stop[stop_point]
-
-                for stop_feature_id in intersected_stop_features:
-                    intersected_stop_point = feature_id_stop_to_point[stop_feature_id]
-                    # intersected_stop_point_geometry = spatial_index_stops.geometry(stop_feature_id) prova questa alternativa e ottenere la geometria
-
-                    intersected_stop_point_id = point_to_id_stop[intersected_stop_point]
-                    # define the area of the rectangle for the intersected stop point
-                    x_min = intersected_stop_point.x() - RADIUS
-                    y_min = intersected_stop_point.y() - RADIUS
-                    x_max = intersected_stop_point.x() + RADIUS
-                    y_max = intersected_stop_point.y() + RADIUS
-
-                    rectangle_area = QgsRectangle(x_min, y_min, x_max, y_max)
-
-                    intersected_walk_features = spatial_index_walk.intersects(
-                        rectangle_area
-                    )
-
-                    # create a sub spatial index with the intersected walk points
-                    sub_spatial_index_walk = QgsSpatialIndex()
-
-                    for intersected_walk_feature_id in intersected_walk_features:
-                        sub_feature_walk = QgsFeature()
-                        sub_point = feature_id_walk_to_point[
-                            intersected_walk_feature_id
-                        ]
-                        sub_feature_walk.setGeometry(QgsGeometry.fromPointXY(sub_point))
-                        sub_feature_walk.setId(intersected_walk_feature_id)
-                        sub_spatial_index_walk.addFeature(sub_feature_walk)
-
-                    if intersected_stop_point != stop_point and not G.has_edge(
-                        current_stop_point_id, intersected_stop_point_id
-                    ):
-                        if len(intersected_walk_features) == 0:
-                            nearest_walk_point_feature_id = (
-                                spatial_index_walk.nearestNeighbor(
-                                    intersected_stop_point, 1, 0
-                                )[0]
-                            )
-                        else:
-                            nearest_walk_point_feature_id = (
-                                sub_spatial_index_walk.nearestNeighbor(
-                                    intersected_stop_point, 1, 0
-                                )[0]
-                            )  # return a list of ID ordered by distance
-
-                        nearest_walk_point = feature_id_walk_to_point[
-                            nearest_walk_point_feature_id
-                        ]
-
-                        nearest_walk_point_id = point_to_id_walk[nearest_walk_point]
-
-                        distance_meters = nx.shortest_path_length(
-                            G_walk,
-                            current_walk_point_id,
-                            nearest_walk_point_id,
-                            weight="length",
-                        )
-
-                        G.add_edge(
-                            current_stop_point_id,
-                            intersected_stop_point_id,
-                            weight=distance_meters,
-                            transport="walk",
-                            route_type=15,
-                        )
-            else:
-                print("No points found!")
+        # one search task for each stop: the walk nodes to reach, each one with the stop snapped on it
+        tasks = []
+        for i, stop_node in enumerate(stop_nodes):
+            stop_targets = [
+                (int(nearest_walk_positions[j]), int(j))
+                for j in nearby_stops[i]
+                if j != i and not G.has_edge(stop_node, stop_nodes[j])
+            ]
+            if stop_targets:
+                tasks.append((i, int(nearest_walk_positions[i]), stop_targets))
+
+        transfers = None
+        if TRANSFER_WORKERS > 1 and len(tasks) >= PARALLEL_TRANSFERS_MIN_STOPS:
+            tasks_x = stops_x[[task[0] for task in tasks]]
+            tasks_y = stops_y[[task[0] for task in tasks]]
+            chunks = spatial_chunks(
+                tasks,
+                tasks_x,
+                tasks_y,
+                TRANSFER_WORKERS * TRANSFER_CHUNKS_PER_WORKER,
+                TRANSFER_CHUNK_CELL_DEGREES,
+            )
+            transfers = self.compute_transfers_in_pool(walk_graph, chunks)
+
+        if transfers is None:
+            transfers = compute_transfers(
+                walk_graph.arrays, tasks, TRANSFER_RADIUS_METERS
+            )
+
+        G.add_edges_from(
+            (
+                stop_nodes[i],
+                stop_nodes[j],
+                {"weight": distance, "transport": "walk", "route_type": 15},
+            )
+            for i, j, distance in transfers
+        )
+        print(len(transfers), " walking edges added")
 
-            if i % 50 == 0:
-                partial_time = datetime.datetime.now()
-                print("Point ", i, " of ", len(stop_points), " processed")
-                print("Partial time: ", partial_time - start_time)
-        
         end_time = datetime.datetime.now()
         print("Total operation time: ", end_time - start_time)
         print("Subgraphs merged!")
 
+    def compute_transfers_in_pool(self, walk_graph: CSRGraph, chunks: list):
+        """Compute the transfers of the chunks in a pool of processes sharing the memory-mapped pedestrian graph.
+        Return None if the pool can not be used or a worker fails, so that the caller computes them in this process"""
+
+        print("Computing walking edges with ", TRANSFER_WORKERS, " processes...")
+
+        # QGIS embeds Python: the workers must be started with a real interpreter
+        context = multiprocessing.get_context("spawn")
+        python_executable = get_python_executable()
+        if python_executable is None:
+            print("Matching Python interpreter not found, walking edges computed in a single process")
+            return None
+        context.set_executable(python_executable)
+
+        transfers = []
+        with tempfile.TemporaryDirectory() as folder:
+            walk_graph.save_shared_arrays(folder)
+            # unlike multiprocessing.Pool, the executor does not restart the workers that fail
+            # to start or crash: it raises BrokenProcessPool instead of blocking forever
+            try:
+                with ProcessPoolExecutor(
+                    TRANSFER_WORKERS,
+                    mp_context=context,
+                    initializer=init_transfers_worker,
+                    initargs=(folder,),
+                ) as executor:
+                    futures = [
+                        executor.submit(
+                            compute_transfers_worker, (chunk, TRANSFER_RADIUS_METERS)
+                        )
+                        for chunk in chunks
+                    ]
+                    try:
+                        for i, future in enumerate(as_completed(futures)):
+                            transfers.extend(future.result())
+                            print("Chunk ", i + 1, " of ", len(chunks), " processed")
+                    except Exception:
+                        for future in futures:
+                            future.cancel()
+                        raise
+            except Exception as e:
+                print(f"Error in the worker processes: {e}")
+                print("Walking edges computed in a single process")
+                return None
+
+        return transfers
+
     def get_subgraphs(self, G: nx.MultiDiGraph):
-        """Get subgraphs of a MultiDiGraph"""
+        """Get the weakly connected subgraphs of a MultiDiGraph and show them in a single layer labelled by component"""
 
         print("Extracting subgraphs...")
 
-        connected_components = list(nx.weakly_connected_components(G))
-        print("Number of subgraphs: ", len(connected_components))
-
-        project = QgsProject.instance()
-
-        # create a layer for each subgraph
-        for i, component in enumerate(connected_components):
-            subG = G.subgraph(component)
-            name = "subgraph_" + str(i + 1)
-            layer = QgsVectorLayer("LineString?crs=epsg:4326", name, "memory")
-            layer.dataProvider().addAttributes([QgsField("Component", QVariant.Int)])
-            layer.updateFields()
-
-            # add the subgraph to the layer
-            for edge in subG.edges:
-                node1 = subG.nodes[edge[0]]
-                node2 = subG.nodes[edge[1]]
-
-                point1 = QgsPointXY(float(node1["x"]), float(node1["y"]))
-                point2 = QgsPointXY(float(node2["x"]), float(node2["y"]))
+        edges = np.array(list(G.edges()), dtype=np.int64).reshape(-1, 2)
+        components = connected_component_labels(len(G), edges[:, 0], edges[:, 1])
+        print("Number of subgraphs: ", len(np.unique(components)))
+
+        if len(edges) > SUBGRAPHS_LAYER_MAX_EDGES:
+            print("Graph too large, subgraphs layer not created")
+            return
+
+        layer = QgsVectorLayer("LineString?crs=epsg:4326", "subgraphs", "memory")
+        layer.dataProvider().addAttributes([QgsField("Component", QVariant.Int)])
+        layer.updateFields()
+
+        nodes_x = G.graph["node_x"].tolist()
+        nodes_y = G.graph["node_y"].tolist()
+
+        features = []
+        for u, v, component in zip(
+            edges[:, 0].tolist(), edges[:, 1].tolist(), components[edges[:, 0]].tolist()
+        ):
+            feature = QgsFeature()
+            feature.setGeometry(
+                QgsGeometry.fromPolylineXY(
+                    [QgsPointXY(nodes_x[u], nodes_y[u]), QgsPointXY(nodes_x[v], nodes_y[v])]
+                )
+            )
+            feature.setAttributes([component])
+            features.append(feature)
 
-                feature = QgsFeature()
-                feature.setGeometry(QgsGeometry.fromPolylineXY([point1, point2]))
-                feature.setAttributes([i])
-                layer.dataProvider().addFeatures([feature])
+        # all the edges are added with a single call to the provider
+        layer.dataProvider().addFeatures(features)
 
-            change_style_layer(layer, None, "yellow", None, "0.5")
+        change_style_layer(layer, None, "yellow", None, "0.5")
 
-            project.addMapLayer(layer)
-            print("Subgraph ", i + 1, " loaded")
+        QgsProject.instance().addMapLayer(layer)
 
         print("Subgraphs extracted!")
@@ -35,12 +35,20 @@ from qgis.utils import iface
 from pathlib import Path
 from .data_manager import *
 from .inputs import Inputs
+from .gtfs_db import (
+    Database,
+    create_table_statement,
+    create_indexes,
+    create_stop_routes_table,
+)
 
 import os
+import io
 import shutil
 import zipfile
 import sqlite3
 import csv
+from itertools import islice
 
 
 # This loads your .ui file so that PyQt can populate your plugin with the elements from Qt Designer
@@ -48,6 +56,11 @@ FORM_CLASS, _ = uic.loadUiType(
     os.path.join(os.path.dirname(__file__), "route_tracking_dialog_base.ui")
 )
 
+# number of rows inserted with a single executemany during the GTFS import
+IMPORT_BATCH_SIZE = 50000
+# page cache used while importing the GTFS data (KiB)
+IMPORT_CACHE_SIZE_KB = 512 * 1024
+
 
 class route_trackingDialog(QtWidgets.QDialog, FORM_CLASS, Inputs):
     def __init__(self, parent=None, route_tracking=None):
@@ -290,9 +303,16 @@ class route_trackingDialog(QtWidgets.QDialog, FORM_CLASS, Inputs):
         self.close()
 
     def extract_gtfs_data(self, zip_file):
+        conn = None
+        progress_dialog = None
+        partial_db_path = None
+
         try:
             print("Extraction and importation of GTFS data...")
 
+            # release the pooled read connections on the old database
+            Database.close_all_connections()
+
             # remove existing db
             db_folder_path = os.path.join(os.path.dirname(__file__), "GTFS_DB")
             if os.path.exists(db_folder_path):
@@ -307,7 +327,11 @@ class route_trackingDialog(QtWidgets.QDialog, FORM_CLASS, Inputs):
                 "stop_times.txt",
                 "trips.txt",
                 "routes.txt",
+                "calendar.txt",
+                "calendar_dates.txt",
             ]
+            # a feed can define its services with only one of the two calendar files
+            optional_csv = ["calendar.txt", "calendar_dates.txt"]
 
             files_number = len(csv_to_extract)
 
@@ -320,47 +344,67 @@ class route_trackingDialog(QtWidgets.QDialog, FORM_CLASS, Inputs):
             progress_dialog.setWindowModality(2)
             progress_dialog.setMaximum(files_number)
 
-            # temporary directory
-            temp_dir = os.path.join(os.path.dirname(__file__), "temp_gtfs")
-            os.makedirs(temp_dir, exist_ok=True)
-
-            # extract the CSV files from the ZIP file to the temporary directory
-            with zipfile.ZipFile(zip_file, "r") as zip_ref:
-                for file_name in csv_to_extract:
-                    zip_ref.extract(file_name, temp_dir)
-
             # create the database folder
             if not os.path.exists(db_folder_path):
                 os.makedirs(db_folder_path)
             db_path = os.path.join(db_folder_path, "gtfs.db")
 
-            # import the CSV files into the database
-            conn = sqlite3.connect(db_path)
+            # import the CSV files into the database in a single transaction
+            partial_db_path = db_path
+            conn = sqlite3.connect(db_path, isolation_level=None)
             cursor = conn.cursor()
 
+            # bulk load settings, the database is rebuilt from scratch if the import fails
+            cursor.execute("PRAGMA journal_mode = OFF")
+            cursor.execute("PRAGMA synchronous = OFF")
+            cursor.execute("PRAGMA locking_mode = EXCLUSIVE")
+            cursor.execute("PRAGMA temp_store = MEMORY")
+            cursor.execute(f"PRAGMA cache_size = -{IMPORT_CACHE_SIZE_KB}")
+
             progress_dialog.show()
 
-            for index, file_name in enumerate(csv_to_extract, 1):
-                print(f"Importing {file_name}...")
-                progress_dialog.setValue(index)
-                QgsApplication.processEvents()
-
-                with open(os.path.join(temp_dir, file_name), "r") as file_csv:
-                    reader = csv.reader(file_csv)
-                    header = next(reader)
-                    table_name = file_name.replace(".txt", "")
-                    cursor.execute(
-                        f'CREATE TABLE IF NOT EXISTS {table_name} ({", ".join(header)})'
-                    )
-                    cursor.executemany(
-                        f'INSERT INTO {table_name} VALUES ({", ".join(["?"] * len(header))})',
-                        reader,
-                    )
-
-            conn.commit()
-            conn.close()
+            cursor.execute("BEGIN")
 
-            shutil.rmtree(temp_dir)
+            # stream the CSV files directly from the ZIP file
+            with zipfile.ZipFile(zip_file, "r") as zip_ref:
+                zip_files = set(zip_ref.namelist())
+                for index, file_name in enumerate(csv_to_extract, 1):
+                    if file_name in optional_csv and file_name not in zip_files:
+                        continue
+
+                    print(f"Importing {file_name}...")
+                    progress_dialog.setValue(index)
+                    QgsApplication.processEvents()
+
+                    with zip_ref.open(file_name, "r") as zip_member:
+                        file_csv = io.TextIOWrapper(
+                            zip_member, encoding="utf-8-sig", newline=""
+                        )
+                        reader = csv.reader(file_csv)
+                        header = [column.strip() for column in next(reader)]
+                        table_name = file_name.replace(".txt", "")
+                        cursor.execute(create_table_statement(table_name, header))
+
+                        # duplicated keys in the feed keep the first row
+                        insert_statement = f'INSERT OR IGNORE INTO {table_name} VALUES ({", ".join(["?"] * len(header))})'
+                        while True:
+                            batch = list(islice(reader, IMPORT_BATCH_SIZE))
+                            if not batch:
+                                break
+                            cursor.executemany(insert_statement, batch)
+                            QgsApplication.processEvents()
+
+            # indexes are built once all the rows are loaded
+            print("Creating indexes...")
+            create_indexes(cursor)
+            create_stop_routes_table(cursor)
+
+            cursor.execute("COMMIT")
+            partial_db_path = None
+
+            # release the exclusive lock before the database is read
+            conn.close()
+            conn = None
 
             self.route_tracking.create_stops_layer()
 
@@ -378,6 +422,16 @@ class route_trackingDialog(QtWidgets.QDialog, FORM_CLASS, Inputs):
             print(f"Error during the extraction and importation of GTFS data: {e}")
             return False
 
+        finally:
+            if conn is not None:
+                conn.close()
+            if progress_dialog is not None:
+                progress_dialog.close()
+
+            # the database is written without journal: an interrupted import leaves it unusable
+            if partial_db_path is not None and os.path.isfile(partial_db_path):
+                os.remove(partial_db_path)
+
     def on_click_export_graph_folder(self):
         # permit to the user to select a folder where to save the graph folder and then save the folder graphs (is in the plugin folder) in the selected folder
         try:
@@ -428,7 +482,7 @@ class route_trackingDialog(QtWidgets.QDialog, FORM_CLASS, Inputs):
             QTimer.singleShot(1000, self.add_new_graphs_after_delay)
 
             # set the graphs None
-            Inputs.reset_graphs(self)
+            self.route_tracking.reset_graphs()
 
         except Exception as e:
             print(f"Error during the importation of the graphs: {e}")
@@ -1,8 +1,9 @@
-from qgis.PyQt.QtCore import Qt
-from qgis.PyQt.QtGui import QIntValidator
+from qgis.PyQt.QtCore import Qt, QRegExp, QDate
+from qgis.PyQt.QtGui import QIntValidator, QRegExpValidator
 from qgis.PyQt.QtWidgets import (
     QInputDialog,
     QLineEdit,
+    QDateEdit,
     QDialog,
     QVBoxLayout,
     QLabel,
@@ -28,6 +29,7 @@ from qgis.utils import iface
 from .resources import *
 from .analysis_functions import *
 from .data_manager import get_number_analysis
+from .timetable import parse_gtfs_time
 
 import networkx as nx
 
@@ -39,7 +41,7 @@ def get_inputs_from_dialog_service_area(inputs):
     dialog.setWindowTitle("Service Area Analysis")
 
     layout = QVBoxLayout()
-    dialog.setFixedSize(400, 200)
+    dialog.setFixedSize(400, 320)
 
     label = QLabel("Select the points layer to analyse the service area:")
     layout.addWidget(label)
@@ -79,6 +81,34 @@ def get_inputs_from_dialog_service_area(inputs):
     inputs.time_line_edit.setValidator(QIntValidator(5, 60))
     layout.addWidget(inputs.time_line_edit)
 
+    label = QLabel("Insert the departure time to follow the timetable (optional):")
+    layout.addWidget(label)
+
+    # create the departure time line edit
+    inputs.departure_time_line_edit = QLineEdit()
+    inputs.departure_time_line_edit.setPlaceholderText("Departure time (HH:MM)")
+    inputs.departure_time_line_edit.setValidator(
+        QRegExpValidator(QRegExp("([01]?[0-9]|2[0-3]):[0-5][0-9]"))
+    )
+    layout.addWidget(inputs.departure_time_line_edit)
+
+    # with a latest departure every departure of the window is analysed
+    inputs.last_departure_time_line_edit = QLineEdit()
+    inputs.last_departure_time_line_edit.setPlaceholderText(
+        "Latest departure time (HH:MM), optional"
+    )
+    inputs.last_departure_time_line_edit.setValidator(
+        QRegExpValidator(QRegExp("([01]?[0-9]|2[0-3]):[0-5][0-9]"))
+    )
+    layout.addWidget(inputs.last_departure_time_line_edit)
+
+    # only the trips running on this date are followed
+    inputs.service_date_edit = QDateEdit(QDate.currentDate())
+    inputs.service_date_edit.setCalendarPopup(True)
+    inputs.service_date_edit.setDisplayFormat("yyyy-MM-dd")
+    inputs.service_date_edit.setToolTip("Service date of the timetable")
+    layout.addWidget(inputs.service_date_edit)
+
     # create the checkbox
     inputs.checkbox = QCheckBox(
         "Detailed Analysis (May affect the performance of the application)"
@@ -118,7 +148,40 @@ def get_inputs_from_dialog_service_area(inputs):
 
     precise_analysis = inputs.checkbox.isChecked()
 
-    return points, int(time), precise_analysis
+    # without a departure time the service area uses the speed of each route type
+    departure_time = None
+    if inputs.departure_time_line_edit.hasAcceptableInput():
+        departure_time = parse_gtfs_time(inputs.departure_time_line_edit.text() + ":00")
+
+    service_date = None
+    if departure_time is not None:
+        service_date = inputs.service_date_edit.date().toString("yyyyMMdd")
+
+    last_departure_time = None
+    if (
+        departure_time is not None
+        and inputs.last_departure_time_line_edit.hasAcceptableInput()
+    ):
+        last_departure_time = parse_gtfs_time(
+            inputs.last_departure_time_line_edit.text() + ":00"
+        )
+        if last_departure_time <= departure_time:
+            iface.messageBar().pushMessage(
+                "Warning",
+                "The latest departure time must follow the departure time, a single departure is analysed",
+                level=Qgis.Warning,
+                duration=5,
+            )
+            last_departure_time = None
+
+    return (
+        points,
+        int(time),
+        precise_analysis,
+        departure_time,
+        last_departure_time,
+        service_date,
+    )
 
 
 def handle_service_area_input_errors(time):
@@ -144,7 +207,14 @@ def start_service_area_analysis(
     if starting_dialog:
         starting_dialog.close()
     try:
-        points, time, checkbox = get_inputs_from_dialog_service_area(inputs)
+        (
+            points,
+            time,
+            checkbox,
+            departure_time,
+            last_departure_time,
+            service_date,
+        ) = get_inputs_from_dialog_service_area(inputs)
     except TypeError:
         return
 
@@ -153,32 +223,29 @@ def start_service_area_analysis(
     number_analysis = get_number_analysis()
 
     service_area_analysis_operations(
-        crs, points, time, checkbox, G, G_walk, number_analysis
+        crs,
+        points,
+        time,
+        checkbox,
+        G,
+        G_walk,
+        number_analysis,
+        departure_time,
+        last_departure_time,
+        service_date,
     )
 
 
-def create_convex_hull_layer(selected_id_dict: dict, number_analysis: int):
-    """Create a layer with the convex hull of the reachable nodes"""
-    layers = QgsProject.instance().mapLayers().values()
-    service_area_layer = [
-        layer for layer in layers if layer.name().startswith("service_area_")
-    ]
-    layer = service_area_layer[-1]
+def create_convex_hull_layer(
+    layer: QgsVectorLayer, selected_id_dict: dict, number_analysis: int
+):
+    """Create a layer with the convex hull of the features of `layer` reachable from each starting point"""
 
     fields = QgsFields()
     fields.append(QgsField("ID", QVariant.Int))
     fields.append(QgsField("Area", QVariant.Double))
 
-    convex_hull_layer = QgsVectorLayer(
-        "Polygon?crs=" + layer.crs().authid(),
-        f"convex_polygons_{number_analysis}",
-        "memory",
-    )
-
-    convex_hull_layer.dataProvider().addAttributes(fields)
-    convex_hull_layer.updateFields()
-    convex_hull_layer.startEditing()
-
+    features = []
     for key_id, selected_id in selected_id_dict.items():
         # deselect all the features
         layer.removeSelection()
@@ -195,23 +262,32 @@ def create_convex_hull_layer(selected_id_dict: dict, number_analysis: int):
             else:
                 selected_geometry = selected_geometry.combine(feature_geometry)
 
+        if selected_geometry is None:
+            continue
+
         # convert the geometry to a convex hull
         convex_hull = selected_geometry.convexHull()
         area = convex_hull.area() * (111**2)  # convert to km^2
 
-        convex_hull_feature = QgsFeature(convex_hull_layer.fields())
+        convex_hull_feature = QgsFeature(fields)
         convex_hull_feature.setGeometry(convex_hull)
         convex_hull_feature.setAttributes([key_id, area])
 
-        convex_hull_layer.addFeature(convex_hull_feature)
+        features.append(convex_hull_feature)
         layer.removeSelection()
 
+    convex_hull_layer, _ = create_memory_layer(
+        "Polygon",
+        layer.crs(),
+        f"convex_polygons_{number_analysis}",
+        fields,
+        features,
+    )
+
     # print the feature data
     for feature in convex_hull_layer.getFeatures():
         print(feature.attributes())
 
-    convex_hull_layer.commitChanges()
-
     QgsProject.instance().addMapLayer(convex_hull_layer)
 
 
@@ -223,8 +299,12 @@ def service_area_analysis_operations(
     G: nx.DiGraph,
     G_walk: nx.MultiDiGraph,
     number_analysis: int,
+    departure_time: int = None,
+    last_departure_time: int = None,
+    service_date: str = None,
 ):
-    """Operations for service area analysis"""
+    """Operations for service area analysis, following the timetable of `service_date` if a departure time
+    is given and over all the departures until `last_departure_time` if it is given too"""
     progress_bar = QProgressDialog()
     progress_bar.setWindowTitle("Service Area Analysis")
     progress_bar.setLabelText("Analysis in progress...")
@@ -236,22 +316,37 @@ def service_area_analysis_operations(
     progress_bar.show()
     QApplication.processEvents()
 
-    nearest_nodes = []
-    for point in points:
-        current_nearest_node = ox.nearest_nodes(G, point[0], point[1])
-        nearest_nodes.append(current_nearest_node)
+    nearest_nodes = nearest_graph_nodes(
+        G, [point[0] for point in points], [point[1] for point in points]
+    )
 
     # TODO: add the id in modo
     create_and_load_layer_starting_points(crs, nearest_nodes, G, number_analysis)
 
     progress_bar.setValue(20)
 
-    selected_id_dict = create_and_load_layer_reachable_nodes(
-        G, crs, nearest_nodes, time, G_walk, checkbox, number_analysis
-    )
+    if departure_time is not None:
+        service_area_layer, selected_id_dict = create_and_load_layer_reachable_stops(
+            crs,
+            points,
+            time,
+            departure_time,
+            number_analysis,
+            last_departure_time,
+            service_date,
+        )
+    else:
+        selected_id_dict = create_and_load_layer_reachable_nodes(
+            G, crs, nearest_nodes, time, G_walk, checkbox, number_analysis
+        )
+        service_area_layers = QgsProject.instance().mapLayersByName(
+            f"service_area_{number_analysis}"
+        )
+        service_area_layer = service_area_layers[0] if service_area_layers else None
 
     progress_bar.setValue(60)
 
-    create_convex_hull_layer(selected_id_dict, number_analysis)
+    if service_area_layer is not None:
+        create_convex_hull_layer(service_area_layer, selected_id_dict, number_analysis)
 
     progress_bar.setValue(100)
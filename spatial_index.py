@@ -0,0 +1,76 @@
+""" Nearest neighbour and radius searches over lon/lat points, based on a haversine BallTree. """
+
+import numpy as np
+from sklearn.neighbors import BallTree
+
+# mean earth radius in meters, the same used by osmnx
+EARTH_RADIUS = 6371009
+
+
+class HaversineIndex:
+    """Spatial index over lon/lat points answering batched queries with distances in meters"""
+
+    def __init__(self, ids: list, x, y, tree: BallTree = None):
+        """Build the index once over all the points, `ids[i]` identifies the point (`x[i]`, `y[i]`).
+        A `tree` already built over the same points is reused"""
+
+        self.ids = list(ids)
+        self.x = np.asarray(x, dtype=np.float64)
+        self.y = np.asarray(y, dtype=np.float64)
+        if tree is None:
+            tree = BallTree(_to_radians(self.x, self.y), metric="haversine")
+        self.tree = tree
+
+    def nearest_ids(self, x, y) -> list:
+        """Return the id of the nearest indexed point for each query point"""
+
+        positions, _ = self.nearest(x, y)
+        return [self.ids[position] for position in positions.tolist()]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def nearest(self, x, y):
+        """Return the position of the nearest indexed point and its distance in meters for each query point"""
+
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        if len(x) == 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float64)
+
+        distances, positions = self.tree.query(_to_radians(x, y), k=1)
+
+        return positions[:, 0], distances[:, 0] * EARTH_RADIUS
+
+    def query_radius(self, x, y, radius: float, return_distance: bool = False):
+        """Return, for each query point, the positions of the indexed points within `radius` meters.
+        With `return_distance` also return their distances in meters"""
+
+        x = np.atleast_1d(np.asarray(x, dtype=np.float64))
+        y = np.atleast_1d(np.asarray(y, dtype=np.float64))
+        if len(x) == 0:
+            return ([], []) if return_distance else []
+
+        if return_distance:
+            positions, distances = self.tree.query_radius(
+                _to_radians(x, y), r=radius / EARTH_RADIUS, return_distance=True
+            )
+            return list(positions), [d * EARTH_RADIUS for d in distances]
+
+        return list(self.tree.query_radius(_to_radians(x, y), r=radius / EARTH_RADIUS))
+
+
+def haversine_distances(x1, y1, x2, y2):
+    """Great-circle distances in meters between the lon/lat points (`x1`, `y1`) and (`x2`, `y2`), element-wise"""
+
+    x1, y1, x2, y2 = (np.radians(np.asarray(a, dtype=np.float64)) for a in (x1, y1, x2, y2))
+
+    h = np.sin((y2 - y1) / 2) ** 2 + np.cos(y1) * np.cos(y2) * np.sin((x2 - x1) / 2) ** 2
+
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+
+def _to_radians(x, y):
+    """BallTree with the haversine metric expects (lat, lon) pairs in radians"""
+
+    return np.radians(np.column_stack((y, x)))
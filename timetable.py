@@ -0,0 +1,448 @@
+""" Timetable routing over the GTFS stop times with the Connection Scan Algorithm. """
+
+import os
+
+import numpy as np
+from scipy.sparse import csr_matrix
+
+from .gtfs_db import Database
+from .spatial_index import HaversineIndex
+
+# stops closer than this are connected by a walking transfer, as in the routes graph
+FOOTPATH_RADIUS_METERS = 400
+WALK_SPEED_METERS_PER_SECOND = 5 / 3.6
+
+# departures of a time window are analysed every minute, the percentile summarises the slow departures
+PROFILE_STEP_SECONDS = 60
+PROFILE_PERCENTILE = 90
+
+# timetables already built, keyed by the path and modification time of the database and the service date
+_timetables = {}
+# stops index already built, keyed by the path and modification time of the database
+_stops_indexes = {}
+
+
+def parse_gtfs_time(value) -> int:
+    """Seconds after midnight of a GTFS time (HH:MM:SS, hours can exceed 24). None if the time is missing"""
+
+    if not value:
+        return None
+
+    try:
+        hours, minutes, seconds = str(value).strip().split(":")
+        return int(hours) * 3600 + int(minutes) * 60 + int(seconds)
+    except ValueError:
+        return None
+
+
+def format_gtfs_time(seconds: float) -> str:
+    """GTFS time (HH:MM:SS) of a number of seconds after midnight"""
+
+    seconds = int(round(seconds))
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+class Timetable:
+    """Connections between consecutive stops of every trip, sorted by departure time.
+    Only the trips running on the service date are kept, every trip if no date is given or the feed has no calendar."""
+
+    def __init__(
+        self,
+        stops_index: HaversineIndex,
+        stop_names: list,
+        departure_stops,
+        arrival_stops,
+        departure_times,
+        arrival_times,
+        trips,
+    ):
+        self.stop_ids = stops_index.ids
+        self.stop_names = stop_names
+        self.stops_index = stops_index
+
+        order = np.argsort(departure_times, kind="stable")
+        self.departure_stops = np.asarray(departure_stops)[order]
+        self.arrival_stops = np.asarray(arrival_stops)[order]
+        self.departure_times = np.asarray(departure_times)[order]
+        self.arrival_times = np.asarray(arrival_times)[order]
+        self.trips = np.asarray(trips)[order]
+        self.trips_number = int(self.trips.max()) + 1 if len(self.trips) else 0
+
+        self._build_footpaths()
+
+    @classmethod
+    def from_database(cls, database: Database, service_date: str = None):
+        """Build the timetable from the stops and stop_times tables, with the trips of `service_date` (YYYYMMDD)"""
+
+        print("Building timetable...")
+
+        active_trips = None
+        if service_date is not None:
+            active_trips = database.select_active_trip_ids(service_date)
+            if active_trips is None:
+                print("No calendar in the GTFS data, all the trips are considered")
+
+        stops_index, stop_names = load_stops_index(database)
+        stop_index = {stop_id: i for i, stop_id in enumerate(stops_index.ids)}
+
+        trip_index = {}
+        trips, stops_sequence, arrivals, departures = [], [], [], []
+        for trip_id, stop_id, arrival_time, departure_time in (
+            database.iterate_ordered_stop_times()
+        ):
+            if active_trips is not None and trip_id not in active_trips:
+                continue
+
+            stop = stop_index.get(str(stop_id))
+            arrival = parse_gtfs_time(arrival_time)
+            departure = parse_gtfs_time(departure_time)
+            # stops without times (not timepoints) are skipped, the trip connects the timed ones
+            if stop is None or (arrival is None and departure is None):
+                continue
+
+            trips.append(trip_index.setdefault(trip_id, len(trip_index)))
+            stops_sequence.append(stop)
+            arrivals.append(arrival if arrival is not None else departure)
+            departures.append(departure if departure is not None else arrival)
+
+        trips = np.array(trips, dtype=np.int64)
+        stops_sequence = np.array(stops_sequence, dtype=np.int64)
+        arrivals = np.array(arrivals, dtype=np.int64)
+        departures = np.array(departures, dtype=np.int64)
+
+        # a connection links two consecutive stop events of the same trip
+        same_trip = trips[:-1] == trips[1:]
+        valid = same_trip & (arrivals[1:] >= departures[:-1])
+
+        timetable = cls(
+            stops_index,
+            stop_names,
+            stops_sequence[:-1][valid],
+            stops_sequence[1:][valid],
+            departures[:-1][valid],
+            arrivals[1:][valid],
+            trips[:-1][valid],
+        )
+
+        print(len(timetable.departure_times), " connections in the timetable")
+
+        return timetable
+
+    def _build_footpaths(self):
+        """Walking transfers between the stops within the footpath radius, as CSR arrays"""
+
+        positions, distances = self.stops_index.query_radius(
+            self.stops_index.x,
+            self.stops_index.y,
+            FOOTPATH_RADIUS_METERS,
+            return_distance=True,
+        )
+
+        counts = np.array([len(p) for p in positions], dtype=np.int64)
+        self.footpath_indptr = np.concatenate(([0], np.cumsum(counts))).tolist()
+        if counts.sum():
+            self.footpath_stops = np.concatenate(positions).tolist()
+            self.footpath_durations = (
+                np.concatenate(distances) / WALK_SPEED_METERS_PER_SECOND
+            ).tolist()
+        else:
+            self.footpath_stops, self.footpath_durations = [], []
+
+    def access_stops(self, x: float, y: float):
+        """Stops reachable by walking from a point, with the walking time in seconds.
+        If no stop is within the footpath radius the nearest one is used."""
+
+        positions, distances = self.stops_index.query_radius(
+            [x], [y], FOOTPATH_RADIUS_METERS, return_distance=True
+        )
+        positions, distances = positions[0], distances[0]
+        if len(positions) == 0:
+            positions, distances = self.stops_index.nearest([x], [y])
+
+        return positions.tolist(), (distances / WALK_SPEED_METERS_PER_SECOND).tolist()
+
+    def _connections_between(self, start_time: int, end_time: int) -> tuple:
+        """Lists of the connections departing between `start_time` and `end_time`, list indexing is faster than array indexing"""
+
+        start = int(np.searchsorted(self.departure_times, start_time, side="left"))
+        end = int(np.searchsorted(self.departure_times, end_time, side="right"))
+
+        return (
+            self.departure_stops[start:end].tolist(),
+            self.arrival_stops[start:end].tolist(),
+            self.departure_times[start:end].tolist(),
+            self.arrival_times[start:end].tolist(),
+            self.trips[start:end].tolist(),
+        )
+
+    def earliest_arrivals(
+        self, origins: list, departure_time: int, duration: int
+    ) -> csr_matrix:
+        """Travel times in minutes from each origin to the stops reachable within `duration` seconds
+        leaving at `departure_time`, as a sparse origins x stops matrix.
+        Each origin is a (stops, walking seconds) pair as returned by `access_stops`."""
+
+        stops_number = len(self.stop_ids)
+        time_limit = departure_time + duration
+
+        (
+            departure_stops,
+            arrival_stops,
+            departure_times,
+            arrival_times,
+            trips,
+        ) = self._connections_between(departure_time, time_limit)
+
+        footpath_indptr = self.footpath_indptr
+        footpath_stops = self.footpath_stops
+        footpath_durations = self.footpath_durations
+
+        # scratch buffers shared by all the origins, reset only where they were touched
+        arrivals = [np.inf] * stops_number
+        ride_arrivals = [np.inf] * stops_number
+        boarded = bytearray(self.trips_number)
+        touched_stops = []
+        touched_trips = []
+
+        row_indptr = [0]
+        columns = []
+        values = []
+
+        for access_positions, access_durations in origins:
+            for stop, walk in zip(access_positions, access_durations):
+                arrival = departure_time + walk
+                if arrival <= time_limit and arrival < arrivals[stop]:
+                    if arrivals[stop] == np.inf:
+                        touched_stops.append(stop)
+                    arrivals[stop] = arrival
+
+            for c in range(len(departure_times)):
+                trip = trips[c]
+                if not boarded[trip]:
+                    if arrivals[departure_stops[c]] > departure_times[c]:
+                        continue
+                    boarded[trip] = 1
+                    touched_trips.append(trip)
+
+                arrival = arrival_times[c]
+                stop = arrival_stops[c]
+                # footpaths start from every improved ride, even if the stop was reached earlier walking
+                if arrival > time_limit or arrival >= ride_arrivals[stop]:
+                    continue
+                ride_arrivals[stop] = arrival
+
+                if arrival < arrivals[stop]:
+                    if arrivals[stop] == np.inf:
+                        touched_stops.append(stop)
+                    arrivals[stop] = arrival
+
+                # walking transfers towards the nearby stops
+                for f in range(footpath_indptr[stop], footpath_indptr[stop + 1]):
+                    next_stop = footpath_stops[f]
+                    next_arrival = arrival + footpath_durations[f]
+                    if next_arrival <= time_limit and next_arrival < arrivals[next_stop]:
+                        if arrivals[next_stop] == np.inf:
+                            touched_stops.append(next_stop)
+                        arrivals[next_stop] = next_arrival
+
+            touched_stops.sort()
+            for stop in touched_stops:
+                columns.append(stop)
+                values.append((arrivals[stop] - departure_time) / 60)
+                arrivals[stop] = np.inf
+                ride_arrivals[stop] = np.inf
+            for trip in touched_trips:
+                boarded[trip] = 0
+            touched_stops.clear()
+            touched_trips.clear()
+
+            row_indptr.append(len(columns))
+
+        return csr_matrix(
+            (
+                np.array(values, dtype=np.float64),
+                np.array(columns, dtype=np.int64),
+                np.array(row_indptr, dtype=np.int64),
+            ),
+            shape=(len(origins), stops_number),
+        )
+
+    def travel_time_profiles(
+        self,
+        origins: list,
+        first_departure: int,
+        last_departure: int,
+        duration: int,
+        step: int = PROFILE_STEP_SECONDS,
+    ) -> list:
+        """Travel times in minutes within `duration` seconds for the departures every `step` seconds
+        between `first_departure` and `last_departure`, summarised for each origin as a dict of arrays
+        over the stops reachable at least once: stops, first_time (leaving at `first_departure`),
+        min_time, median_time, percentile_time and reachable_share. Missing times are inf.
+
+        The departures are swept from the latest to the earliest keeping the labels, as in rRAPTOR:
+        leaving earlier it is always possible to wait, so the arrivals of the later departures stay
+        valid and a trip is scanned again only from a connection boarded earlier than before."""
+
+        departures = list(range(first_departure, last_departure + 1, step))
+        departures_number = len(departures)
+
+        (
+            departure_stops,
+            arrival_stops,
+            departure_times,
+            arrival_times,
+            trips,
+        ) = self._connections_between(first_departure, departures[-1] + duration)
+        connections_number = len(departure_times)
+        first_connections = np.searchsorted(departure_times, departures).tolist()
+
+        footpath_indptr = self.footpath_indptr
+        footpath_stops = self.footpath_stops
+        footpath_durations = self.footpath_durations
+
+        stops_number = len(self.stop_ids)
+
+        # scratch buffers shared by all the origins, reset only where they were touched
+        arrivals = [np.inf] * stops_number
+        # arrivals by vehicle, a stop reached walking can still be a transfer point
+        ride_arrivals = [np.inf] * stops_number
+        # first connection of each trip already scanned for a later departure
+        scanned_from = [connections_number] * self.trips_number
+        # departure sweep in which each trip was boarded, never reset since the sweeps are numbered
+        boarded = [0] * self.trips_number
+        sweep = 0
+        touched_stops = []
+        touched_trips = []
+        times = np.full((departures_number, stops_number), np.inf)
+
+        profiles = []
+        for access_positions, access_durations in origins:
+            for k in range(departures_number - 1, -1, -1):
+                departure_time = departures[k]
+                time_limit = departure_time + duration
+                sweep += 1
+                boarded_from = {}
+
+                for stop, walk in zip(access_positions, access_durations):
+                    arrival = departure_time + walk
+                    if arrival <= time_limit and arrival < arrivals[stop]:
+                        if arrivals[stop] == np.inf:
+                            touched_stops.append(stop)
+                        arrivals[stop] = arrival
+
+                for c in range(first_connections[k], connections_number):
+                    if departure_times[c] > time_limit:
+                        break
+
+                    trip = trips[c]
+                    if boarded[trip] != sweep:
+                        # the rest of the trip was already scanned for a later departure
+                        if c >= scanned_from[trip]:
+                            continue
+                        if arrivals[departure_stops[c]] > departure_times[c]:
+                            continue
+                        boarded[trip] = sweep
+                        boarded_from[trip] = c
+
+                    arrival = arrival_times[c]
+                    stop = arrival_stops[c]
+                    # footpaths start from every improved ride, even if the stop was reached earlier walking
+                    if arrival > time_limit or arrival >= ride_arrivals[stop]:
+                        continue
+                    ride_arrivals[stop] = arrival
+
+                    if arrival < arrivals[stop]:
+                        if arrivals[stop] == np.inf:
+                            touched_stops.append(stop)
+                        arrivals[stop] = arrival
+
+                    # walking transfers towards the nearby stops
+                    for f in range(footpath_indptr[stop], footpath_indptr[stop + 1]):
+                        next_stop = footpath_stops[f]
+                        next_arrival = arrival + footpath_durations[f]
+                        if next_arrival <= time_limit and next_arrival < arrivals[next_stop]:
+                            if arrivals[next_stop] == np.inf:
+                                touched_stops.append(next_stop)
+                            arrivals[next_stop] = next_arrival
+
+                for trip, c in boarded_from.items():
+                    if scanned_from[trip] == connections_number:
+                        touched_trips.append(trip)
+                    scanned_from[trip] = c
+
+                for stop in touched_stops:
+                    travel_time = arrivals[stop] - departure_time
+                    if travel_time <= duration:
+                        times[k, stop] = travel_time / 60
+
+            stops = np.array(sorted(touched_stops), dtype=np.int64)
+            profiles.append(_summarise_travel_times(stops, times[:, stops]))
+
+            times[:, stops] = np.inf
+            for stop in touched_stops:
+                arrivals[stop] = np.inf
+                ride_arrivals[stop] = np.inf
+            for trip in touched_trips:
+                scanned_from[trip] = connections_number
+            touched_stops.clear()
+            touched_trips.clear()
+
+        return profiles
+
+
+def _summarise_travel_times(stops, times) -> dict:
+    """Statistics of the travel times of each stop (columns) over the departures (rows)"""
+
+    departures_number = times.shape[0]
+    sorted_times = np.sort(times, axis=0)
+
+    # nearest-rank statistics, an unreachable departure counts as an infinite travel time
+    def nearest_rank(percentile):
+        rank = max(int(np.ceil(percentile / 100 * departures_number)) - 1, 0)
+        return sorted_times[rank]
+
+    return {
+        "stops": stops,
+        "first_time": times[0],
+        "min_time": sorted_times[0],
+        "median_time": nearest_rank(50),
+        "percentile_time": nearest_rank(PROFILE_PERCENTILE),
+        "reachable_share": np.isfinite(times).sum(axis=0) / departures_number,
+    }
+
+
+def load_timetable(database: Database = None, service_date: str = None) -> Timetable:
+    """Timetable of the GTFS database on `service_date` (YYYYMMDD), built once and reused
+    until the database or the date changes"""
+
+    database = database or Database()
+    key = (database._path, os.path.getmtime(database._path), service_date)
+
+    if key not in _timetables:
+        _timetables.clear()
+        _timetables[key] = Timetable.from_database(database, service_date)
+
+    return _timetables[key]
+
+
+def load_stops_index(database: Database = None) -> tuple:
+    """Spatial index of the GTFS stops and their names, built once and reused until the database changes.
+    The same index is used by the timetables and by the nearby stops analysis"""
+
+    database = database or Database()
+    key = (database._path, os.path.getmtime(database._path))
+
+    if key not in _stops_indexes:
+        stops = database.select_all_coordinates_stops()
+        _stops_indexes.clear()
+        _stops_indexes[key] = (
+            HaversineIndex(
+                [str(stop_id) for stop_id, _, _, _ in stops],
+                [float(stop_lon) for _, _, _, stop_lon in stops],
+                [float(stop_lat) for _, _, stop_lat, _ in stops],
+            ),
+            [stop_name for _, stop_name, _, _ in stops],
+        )
+
+    return _stops_indexes[key]
@@ -3,6 +3,9 @@ from qgis.core import (
     QgsLineSymbol,
     QgsSingleSymbolRenderer,
     QgsMapLayer,
+    QgsVectorLayer,
+    QgsFields,
+    QgsCoordinateReferenceSystem,
 )
 
 from .resources import *
@@ -27,44 +30,132 @@ def change_style_layer(
     layer_name.setRenderer(renderer)
 
 
-def route_type_to_speed(route_type: int) -> int:
-    """Convert route type to speed"""
+def create_memory_layer(
+    geometry_type: str,
+    crs: QgsCoordinateReferenceSystem,
+    layer_name: str,
+    fields: QgsFields,
+    features: list,
+) -> tuple:
+    """Create a memory layer and write all its features with a single call to the data provider,
+    without going through the edit buffer. Return the layer and the features with their assigned ids"""
+
+    layer = QgsVectorLayer(geometry_type + "?crs=" + crs.authid(), layer_name, "memory")
+
+    provider = layer.dataProvider()
+    provider.addAttributes(fields)
+    layer.updateFields()
+
+    _, added_features = provider.addFeatures(features)
+    layer.updateExtents()
+
+    return layer, added_features
+
+
+# speed in km/h of each GTFS route type, extended route types included
+ROUTE_TYPE_SPEEDS = {}
+
+
+def set_route_type_speed(route_types: list, speed: int):
+    """Set the speed in km/h of the route types, the graphs already loaded
+    keep their travel times until `add_travel_times` is called again"""
+
+    ROUTE_TYPE_SPEEDS.update(dict.fromkeys(route_types, speed))
+
+
+for route_types, speed in [
     # tram
-    if route_type in [0, 900, 901, 902, 903, 904, 905, 906]:
-        return 23
+    ([0, 900, 901, 902, 903, 904, 905, 906], 23),
     # subway, metro
-    elif route_type in [1, 400, 401, 402, 403, 404]:
-        return 60
+    ([1, 400, 401, 402, 403, 404], 60),
     # rail (long distance travel)
-    elif route_type in [2, 100, 101, 102, 103, 104, 105, 106, 107, 108, 109, 110, 111, 112, 113, 114, 115, 116, 117]:
-        return 160
+    ([2, 100, 101, 102, 103, 104, 105, 106, 107, 108, 109, 110, 111, 112, 113, 114, 115, 116, 117], 160),
     # bus
-    elif route_type in [3, 200, 201, 202, 203, 204, 205, 206, 207, 208, 209, 700, 702, 703, 704, 706, 707, 708, 709, 710, 712, 713]:
-        return 25
+    ([3, 200, 201, 202, 203, 204, 205, 206, 207, 208, 209, 700, 702, 703, 704, 706, 707, 708, 709, 710, 712, 713], 25),
     # ferry
-    elif route_type in [4, 1200]:
-        return 40
+    ([4, 1200], 40),
     # cable tram
-    elif route_type == 5:
-        return 23
+    ([5], 23),
     # aerial lift
-    elif route_type == 6:
-        return 20
+    ([6], 20),
     # funicular
-    elif route_type in [7, 1400]:
-        return 25
+    ([7, 1400], 25),
     # trolleybus
-    elif route_type in [11, 800]:
-        return 20
+    ([11, 800], 20),
     # monorail
-    elif route_type in [12, 405]:
-        return 70
+    ([12, 405], 70),
     # long distance bus
-    elif route_type in [701, 705, 711, 715, 716]:
-        return 100
+    ([701, 705, 711, 715, 716], 100),
     # walk
-    elif route_type == 15:
-        return 5
+    ([15], 5),
+]:
+    set_route_type_speed(route_types, speed)
+
+
+def route_type_to_speed(route_type: int) -> int:
+    """Convert route type to speed"""
+
+    return ROUTE_TYPE_SPEEDS.get(route_type)
+
+
+def add_travel_times(G):
+    """Store in each edge of the routes graph its travel time in minutes,
+    edges of a route type without speed can not be travelled.
+    The travel times are also stored as CSR arrays in `G.graph["travel_times"]`"""
+
+    # imported here because this module is loaded by `classFactory` before `import_libs`
+    import numpy as np
+
+    from .csr_graph import CSRGraph
+
+    for _, _, data in G.edges(data=True):
+        speed = route_type_to_speed(data.get("route_type"))
+        if speed:
+            data["travel_time"] = (data["weight"] / 1000) / speed * 60
+        else:
+            data["travel_time"] = float("inf")
+
+    G.graph["travel_times"] = CSRGraph.from_networkx(
+        G, "travel_time", dtype=np.float32
+    )
+
+    return G
+
+
+def get_python_executable():
+    """Path of the Python interpreter used to start worker processes.
+    Inside QGIS `sys.executable` can be the QGIS application itself, so the interpreter
+    next to the running Python is used, only if it is the same Python version"""
+
+    import os
+    import subprocess
+    import sys
+
+    if os.path.basename(sys.executable).lower().startswith("python"):
+        return sys.executable
+
+    if sys.platform == "win32":
+        candidate = os.path.join(sys.exec_prefix, "python.exe")
+    else:
+        candidate = os.path.join(sys.exec_prefix, "bin", "python3")
+
+    if not os.path.exists(candidate):
+        return None
+
+    try:
+        version = subprocess.run(
+            [candidate, "-c", "import sys; print(tuple(sys.version_info[:3]))"],
+            capture_output=True,
+            text=True,
+            timeout=30,
+        ).stdout.strip()
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+    if version != str(tuple(sys.version_info[:3])):
+        return None
+
+    return candidate
 
 
 # def import_libs():